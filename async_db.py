@@ -0,0 +1,101 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from db import POOL_SIZE
+
+
+# Readers run concurrently (WAL lets them proceed while a write is in progress),
+# one pooled connection is left over for the writer
+READ_WORKERS = max(POOL_SIZE - 1, 1)
+
+_readers = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix="db-read")
+
+# Writes to one database are serialised on its own single thread, so writers of
+# collections stored in different files never wait on each other. Writers are
+# created on first use and retired with their collection (tenants.close_shard)
+_writers = {}
+_writers_lock = threading.Lock()
+
+# Writes submitted to a database's writer and not finished yet, and the
+# databases whose writer stops once they are
+_pending = {}
+_retiring = set()
+
+
+async def run_read(func, *args, **kwargs):
+    """
+    Run a read-only sql.py function on the reader threads without blocking the event loop.
+
+    :param func: The function to call, e.g. search_card.
+    :return: Whatever the function returns.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_readers, functools.partial(func, *args, **kwargs))
+
+
+def _finished(db_name: str, future) -> None:
+    with _writers_lock:
+        _pending[db_name] -= 1
+        if _pending[db_name]:
+            return
+        del _pending[db_name]
+        if db_name not in _retiring:
+            return
+        _retiring.discard(db_name)
+        writer = _writers.pop(db_name)
+    writer.shutdown(wait=False)
+
+
+def retire_writer(db_name: str) -> None:
+    """
+    Stop the writer thread of a database once its queued writes are done.
+
+    Until then the thread stays the database's writer, so a write arriving
+    meanwhile queues behind the others instead of starting a second writer
+    that would compete for the database lock. A later write starts a new one.
+
+    :param db_name: The SQLite database file name (e.g., 'data.db').
+    """
+    with _writers_lock:
+        writer = _writers.get(db_name)
+        if writer is None:
+            return
+        if _pending.get(db_name):
+            _retiring.add(db_name)
+            return
+        del _writers[db_name]
+    writer.shutdown(wait=False)
+
+
+async def run_write(func, db_name: str, *args, **kwargs):
+    """
+    Run a mutating sql.py function on the writer thread of its database without blocking the event loop.
+
+    :param func: The function to call, e.g. add_cards_from_file.
+    :param db_name: The database written to, passed on as the first argument.
+    :return: Whatever the function returns.
+    """
+    with _writers_lock:
+        writer = _writers.get(db_name)
+        if writer is None:
+            writer = _writers[db_name] = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        _pending[db_name] = _pending.get(db_name, 0) + 1
+        future = writer.submit(func, db_name, *args, **kwargs)
+    # Counted down by the writer thread itself, even if the awaiting task is cancelled
+    future.add_done_callback(functools.partial(_finished, db_name))
+    return await asyncio.wrap_future(future)
+
+
+def shutdown() -> None:
+    """
+    Wait for queued database work to finish and stop the worker threads.
+    """
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+        _retiring.clear()
+    for writer in writers:
+        writer.shutdown(wait=True)
+    _readers.shutdown(wait=True)
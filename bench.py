@@ -0,0 +1,349 @@
+"""
+Benchmark the sql.py data layer against synthetic inventories.
+
+Every run builds throwaway databases in a temporary directory, so it needs
+neither the bot token nor network access and never touches data.db:
+
+    python bench.py
+    python bench.py --sizes 1000 100000 --repeat 20 --output before.jsonl
+    python bench.py --sizes 1000 100000 --repeat 20 --baseline before.jsonl
+
+Results are written as JSON lines, one per (function, inventory size, deck
+size), with latency percentiles in milliseconds, throughput and peak memory.
+Peak memory (peak_memory_kb) is what tracemalloc sees, Python allocations
+only: SQLite's page cache and other allocations of its own are not included.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import sql
+from cache import drop_cache
+from createDB import load_rows
+from db import close_pool
+from fuzzy import drop_index
+from schema import TABLE_NAME
+
+
+COLUMN_NAME = "name"
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+DEFAULT_DECK_SIZES = (60, 100, 1000)
+DEFAULT_REPEAT = 10
+
+# Share of generated names that are double-faced "A // B" cards
+DOUBLE_FACED_RATIO = 0.1
+
+# Share of decklist lines that are owned, misspelled or not owned at all
+OWNED_RATIO = 0.6
+TYPO_RATIO = 0.1
+
+# Rows inserted per executemany while building an inventory
+LOAD_BATCH_SIZE = 10000
+
+_PREFIXES = ("Ancient", "Blazing", "Cursed", "Drowned", "Ethereal", "Feral", "Gilded", "Hollow",
+             "Iron", "Jade", "Kindled", "Lunar", "Molten", "Nether", "Obsidian", "Primal",
+             "Quiet", "Radiant", "Savage", "Thorned", "Umbral", "Verdant", "Wicked", "Zealous")
+_SUBJECTS = ("Angel", "Basilisk", "Colossus", "Dragon", "Elemental", "Faerie", "Golem", "Hydra",
+             "Imp", "Juggernaut", "Kraken", "Lich", "Minotaur", "Naga", "Ogre", "Phoenix",
+             "Rebuke", "Sphinx", "Titan", "Unicorn", "Vampire", "Wurm", "Wraith", "Zombie")
+_SUFFIXES = ("of the Deep", "of Ruin", "of the Wilds", "Reborn", "Ascendant", "Unbound",
+             "of Embers", "of Ashes", "Eternal", "of the Vale", "of the Spire", "Awakened")
+
+
+def card_names(count: int, seed: int) -> list:
+    """
+    Generate unique, card-like names, some of them double-faced.
+
+    :param count: The number of names to generate.
+    :param seed: The random seed, the same seed always gives the same names.
+    :return: A list of `count` distinct names (case-insensitively).
+    """
+    rng = random.Random(seed)
+    names = []
+    seen = set()
+    serial = 0
+
+    def single():
+        nonlocal serial
+        serial += 1
+        words = [rng.choice(_PREFIXES), rng.choice(_SUBJECTS)]
+        if rng.random() < 0.5:
+            words.append(rng.choice(_SUFFIXES))
+        # The serial keeps names unique once the word combinations run out
+        return " ".join(words) + f" {serial:x}"
+
+    while len(names) < count:
+        if rng.random() < DOUBLE_FACED_RATIO:
+            name = f"{single()} // {single()}"
+        else:
+            name = single()
+        if name.lower() not in seen:
+            seen.add(name.lower())
+            names.append(name)
+    return names
+
+
+def misspell(name: str, rng: random.Random) -> str:
+    """
+    Swap two adjacent letters of a name, the most common typo.
+    """
+    positions = [i for i in range(len(name) - 1) if name[i].isalpha() and name[i + 1].isalpha() and name[i] != name[i + 1]]
+    if not positions:
+        return name
+    i = rng.choice(positions)
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def decklist(inventory: list, deck_size: int, rng: random.Random, prefix: str = "Unowned") -> str:
+    """
+    Build decklist text ("name, quantity" lines) mixing owned, misspelled and unknown cards.
+
+    :param inventory: The names in the inventory.
+    :param deck_size: The number of lines.
+    :param rng: The random generator to draw from.
+    :param prefix: The first word of the names that are not in the inventory.
+    """
+    lines = []
+    for i in range(deck_size):
+        roll = rng.random()
+        if inventory and roll < OWNED_RATIO:
+            name = rng.choice(inventory)
+        elif inventory and roll < OWNED_RATIO + TYPO_RATIO:
+            name = misspell(rng.choice(inventory), rng)
+        else:
+            name = f"{prefix} Card {rng.getrandbits(48):x}"
+        lines.append(f"{name}, {rng.randint(1, 4)}")
+    return "\n".join(lines)
+
+
+def unowned_decklist(deck_size: int, rng: random.Random) -> str:
+    """
+    Build decklist text where no card is owned yet, so add_diff adds every line.
+    """
+    return "\n".join(f"Missing Card {rng.getrandbits(48):x}, {rng.randint(1, 4)}" for _ in range(deck_size))
+
+
+def load_inventory(db_name: str, names: list, seed: int) -> float:
+    """
+    Fill a fresh database with the given names.
+
+    Names are stored lowercase like every other write does, otherwise the
+    adds of the benchmark would index each owned card a second time.
+
+    :return: The number of seconds the load took.
+    """
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    load_rows(db_name, ((name.lower(), rng.randint(1, 8)) for name in names), TABLE_NAME, LOAD_BATCH_SIZE)
+    return time.perf_counter() - started
+
+
+def percentile(samples: list, fraction: float) -> float:
+    """
+    Return the nearest-rank percentile of a list of samples.
+    """
+    ordered = sorted(samples)
+    rank = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def measure(name: str, calls, items_per_call: int, repeat: int, **labels) -> dict:
+    """
+    Time a benchmarked function, then run it once more under tracemalloc for its peak memory.
+
+    Memory tracing slows Python code down a lot, so it is kept out of the timed runs.
+    The peak only covers Python allocations, not the ones SQLite makes itself.
+
+    :param name: The name of the benchmarked function.
+    :param calls: A callable returning a fresh zero-argument callable for each run.
+    :param items_per_call: Cards or rows handled per run, for the throughput.
+    :param repeat: The number of timed runs.
+    :param labels: Extra fields stored with the result (e.g., inventory size).
+    :return: The result record.
+    """
+    samples = []
+    for _ in range(repeat):
+        call = calls()
+        started = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - started)
+
+    call = calls()
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    total = sum(samples)
+    return {
+        "function": name,
+        **labels,
+        "repeat": repeat,
+        "p50_ms": round(percentile(samples, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+        "min_ms": round(min(samples) * 1000, 3),
+        "throughput_per_s": round(items_per_call * repeat / total, 1) if total else None,
+        "peak_memory_kb": round(peak / 1024, 1),
+    }
+
+
+def bench_inventory(directory: str, size: int, deck_sizes, repeat: int, export_repeat: int, seed: int):
+    """
+    Run every benchmark against one inventory size.
+
+    :return: A generator of result records.
+    """
+    db_name = os.path.join(directory, f"bench_{size}.db")
+    names = card_names(size, seed)
+    load_seconds = load_inventory(db_name, names, seed)
+    yield {"function": "load_inventory", "inventory_size": size, "seconds": round(load_seconds, 3),
+           "throughput_per_s": round(size / load_seconds, 1) if load_seconds else None}
+
+    rng = random.Random(seed + size)
+
+    # Warm the fuzzy index and the inventory cache, as the bot does on startup
+    started = time.perf_counter()
+    sql.get_index(db_name, TABLE_NAME)
+    sql.get_cache(db_name, TABLE_NAME)
+    yield {"function": "warm_up", "inventory_size": size, "seconds": round(time.perf_counter() - started, 3)}
+
+    def search_calls():
+        roll = rng.random()
+        if roll < 0.6:
+            # A word of an owned card, which usually matches many rows
+            substring = rng.choice(rng.choice(names).split())
+        elif roll < 0.9:
+            substring = rng.choice(names)
+        else:
+            # Nothing matches, so suggestions are computed
+            substring = misspell(rng.choice(names), rng) + "q"
+        return lambda: sql.search_card(db_name, TABLE_NAME, COLUMN_NAME, substring)
+
+    yield measure("search_card", search_calls, 1, repeat * 10, inventory_size=size, deck_size=None)
+
+    for deck_size in deck_sizes:
+        labels = {"inventory_size": size, "deck_size": deck_size}
+
+        def compare_calls():
+            text = decklist(names, deck_size, rng)
+            return lambda: sql.search_card_exact_and_compare(db_name, TABLE_NAME, COLUMN_NAME, text)
+
+        yield measure("search_card_exact_and_compare", compare_calls, deck_size, repeat, **labels)
+
+        # Adding then removing the same list leaves the inventory as it was
+        pending = []
+
+        def add_calls():
+            text = decklist(names, deck_size, rng, prefix="Added")
+            pending.append(text)
+            return lambda: sql.add_cards_from_file(db_name, TABLE_NAME, text)
+
+        def remove_calls():
+            text = pending.pop(0)
+            return lambda: sql.remove_cards_from_file(db_name, TABLE_NAME, text)
+
+        yield measure("add_cards_from_file", add_calls, deck_size, repeat, **labels)
+        yield measure("remove_cards_from_file", remove_calls, deck_size, repeat, **labels)
+
+        def add_diff_calls():
+            text = unowned_decklist(deck_size, rng)
+            return lambda: sql.add_diff(db_name, TABLE_NAME, text)
+
+        yield measure("add_diff", add_diff_calls, deck_size, repeat, **labels)
+
+    export_directory = os.path.join(directory, "exports")
+    os.makedirs(export_directory, exist_ok=True)
+
+    def export_calls():
+        def call():
+            path = sql.return_inventory_file(db_name, TABLE_NAME, export_directory)
+            if os.path.exists(path):
+                os.remove(path)
+        return call
+
+    yield measure("return_inventory_file", export_calls, size, export_repeat, inventory_size=size, deck_size=None)
+
+    drop_index(db_name, TABLE_NAME)
+    drop_cache(db_name, TABLE_NAME)
+    close_pool(db_name)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_name + suffix):
+            os.remove(db_name + suffix)
+
+
+def result_key(record: dict) -> tuple:
+    return record.get("function"), record.get("inventory_size"), record.get("deck_size")
+
+
+def load_baseline(path: str) -> dict:
+    """
+    Read the results of an earlier run, keyed by (function, inventory size, deck size).
+    """
+    baseline = {}
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                if "p50_ms" in record:
+                    baseline[result_key(record)] = record
+    return baseline
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the sql.py data layer against synthetic inventories.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="inventory sizes in cards")
+    parser.add_argument("--deck-sizes", type=int, nargs="+", default=DEFAULT_DECK_SIZES, help="decklist sizes in lines")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="timed runs per measurement")
+    parser.add_argument("--export-repeat", type=int, default=3, help="timed runs of the inventory export")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the synthetic data")
+    parser.add_argument("--output", default="bench_output.txt", help="JSON lines file to write the results to")
+    parser.add_argument("--baseline", help="JSON lines file of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+
+    meta = {
+        "function": "meta",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "repeat": args.repeat,
+    }
+
+    directory = tempfile.mkdtemp(prefix="bench_")
+    try:
+        with open(args.output, "w") as output:
+            output.write(json.dumps(meta) + "\n")
+            for size in args.sizes:
+                for record in bench_inventory(directory, size, args.deck_sizes, args.repeat, args.export_repeat, args.seed):
+                    previous = baseline.get(result_key(record))
+                    if previous and previous["p50_ms"]:
+                        record["baseline_p50_ms"] = previous["p50_ms"]
+                        record["p50_change"] = round(record["p50_ms"] / previous["p50_ms"] - 1, 3)
+                    line = json.dumps(record)
+                    output.write(line + "\n")
+                    output.flush()
+                    print(line, file=sys.stdout, flush=True)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,52 @@
 import aiohttp
+import asyncio
+import io
 import os
 import logging
-import subprocess
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 from sql import *
+from db import close_all
+from ingest import iter_batches, iter_lines, read_body, create_session, check_download_size
+from replies import send_rows
+from fuzzy import get_index
+from cache import get_cache, check_cache
+from async_db import run_read, run_write
+from metrics import timed_command, format_stats
+from jobs import JobQueue, Progress, TooManyJobs
+from tenants import collection_for, open_shards
+from coalesce import change_card
+from compare_cache import get_results
+from decklist import read_decklist_archive
+import async_db
+import metrics
+import webhook
 
 
-db_name = 'data.db'
 table_name = 'cards'
 column_name = 'name'
 
 authorized_users = []  # Add your user IDs here
 
+# Uploaded decklists can be plain text or CSV, see decklist.DECKLIST_FORMATS
+UPLOAD_MIME_TYPES = ('text/plain', 'text/csv', 'text/comma-separated-values')
+
+# /allocate also takes a zip archive of decklists, one deck per file
+ARCHIVE_MIME_TYPES = ('application/zip', 'application/x-zip-compressed')
+
+# Updates handled at the same time, so a slow command does not hold up everyone else's
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "16"))
+
+# Seconds between consistency checks of the open inventory caches, 0 disables them
+CACHE_CHECK_INTERVAL = float(os.environ.get("CACHE_CHECK_INTERVAL", "3600"))
+
+# Seconds to wait for the rest of a media group, its documents arrive as separate updates
+MEDIA_GROUP_WAIT = 2.0
+
+# The chat that keeps the inventory from before collections were split (data.db)
+legacy_owner = None
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.WARNING
@@ -43,12 +76,11 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Join all the arguments to form the search query
     query = ' '.join(context.args)
     if query:
-        response = search_card(db_name,table_name,column_name,query)
+        response = await run_read(search_card, collection(update), table_name, column_name, query)
         if response =="No results...":
             await update.message.reply_text(response)
         else:
-            for row in response:
-                await update.message.reply_text(row)
+            await send_rows(update, response, filename="search.txt")
     else:
         await update.message.reply_text('Please provide a query.')
 
@@ -59,7 +91,8 @@ async def add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
     query = ' '.join(context.args)
     if query:
-        response = add_or_update_quantity(db_name,table_name,column_name,query)
+        # Shares a transaction with other /add and /remove commands arriving at the same time
+        response = await change_card(collection(update), table_name, "add", query)
         await update.message.reply_text(response)
     else:
         await update.message.reply_text('Please provide a query.')
@@ -70,7 +103,7 @@ async def remove(update: Update, context: ContextTypes.DEFAULT_TYPE)->None:
         return
     query = ' '.join(context.args)
     if query:
-        response = subtract_quantity(db_name,table_name,column_name,query)
+        response = await change_card(collection(update), table_name, "remove", query)
         await update.message.reply_text(response)
     else:
         await update.message.reply_text('Please provide a query.')
@@ -80,34 +113,25 @@ async def remove_all(update: Update, context: ContextTypes.DEFAULT_TYPE)->None:
         await update.message.reply_text('You are not authorized to use this bot.')
         return
     query = ' '.join(context.args)
-    if query != "all":
-        response = subtract_quantity(db_name,table_name,query)
+    if not query:
+        await update.message.reply_text('Please provide a query.')
+    elif query == "all":
+        # One transaction: snapshot to the backup table, then clear
+        removed = await run_write(reset_inventory, collection(update), table_name)
+        await update.message.reply_text(f"All cards have been removed ({removed} entries), inventory has been reset. The previous inventory was saved to the {table_name}_backup table. Check /return_inv_file to veryify.")
+    else:
+        response = await run_write(remove_card, collection(update), table_name, query)
         await update.message.reply_text(response)
-    if query == "all":
-        inv = return_inventory_file(db_name, table_name, "./")
-        if inv != "No inventory to write.":
-            with open(inv, "r") as file:
-                content = file.read()
-                for row in content.split("\n"):
-                    if row:
-                        subtract_quantity(db_name,table_name,row)
-            os.remove(inv)
-            await update.message.reply_text("All cards have been removed, inventory has been reset. Check /return_inv_file to veryify.")
-        else:
-            await update.message.reply_text(f"Failed to remove all cards. {inv}")
 
-    else:
-        await update.message.reply_text('Please provide a query.')
-        
 async def compare(update: Update, context: ContextTypes.DEFAULT_TYPE)->None:
     if not loggingAuth("compare", update.message.from_user.id, update.message.from_user.first_name, check_user(update, context)):
         await update.message.reply_text('You are not authorized to use this bot.')
+        return
     query = ' '.join(context.args)
     if query:
-        response = search_card_exact_and_compare(db_name,table_name,column_name, file_path=query)
+        response = await run_read(search_card_exact_and_compare, collection(update), table_name, column_name, file_path=query)
         if isinstance(response,list):
-            for row in response:
-             await update.message.reply_text(row)
+            await send_rows(update, response, filename="compare.txt")
         else:
             await update.message.reply_text(response)
     else:
@@ -118,77 +142,245 @@ async def handle_file_upload(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text('You are not authorized to use this bot.')
         return
     # logging.info(update.message.chat.first_name + "" + " uploaded a file")
-    command = update.message.caption.split()[0]
+    if update.message.media_group_id:
+        collect_media_group(update, context)
+        return
+    await accept_upload(update, context)
+
+async def accept_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    caption = update.message.caption or ""
+    command = caption.split()[0] if caption.split() else ""
+    if not (command.__contains__("/compare") or command in ("/add", "/remove", "/add_diff", "/import", "/allocate")):
+        await update.message.reply_text('Please provide a valid command.')
+        return
     file = update.message.document
-    if file.mime_type == 'text/plain':  # Ensure it's a text file
-            file_id = file.file_id
-            new_file = await context.bot.get_file(file_id)
-            file_url = new_file.file_path
-    else:
-            await update.message.reply_text('Please upload a valid text file.')
-    if command.__contains__("/compare"):  
-        # Open the file in memory without saving it locally
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as response:
-                if response.status == 200:
-                    content = search_card_exact_and_compare(db_name,table_name,column_name, await response.text())
-                    response = ""
-                    if not command.__contains__("file"):
-                        for row in content:
-                            if not row.__contains__("0"):
-                                response += f"{row.split(':')[1].replace('you need ','').strip()} {row.split(':')[0].replace('Found ', '').strip()}\n".replace('"','')
-                        create_file("diff.txt", response)
-                        if os.path.exists("diff.txt"):
-                            await context.bot.send_document(chat_id=update.message.chat_id, document=open("diff.txt", 'rb'))
-                            os.remove("diff.txt")
-                            return
-                        await update.message.reply_text("failed to create file")
-                    else:
-                        for row in content:
-                            response += row + "\n"
-                        await update.message.reply_text(response)
-                else:
-                    await update.message.reply_text('Failed to read the file content. Please try again.')
-                return
-    if command == "/add":
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as response:
-                if response.status == 200:
-                    content = add_cards_from_file(db_name,table_name, await response.text())
-                    response = ""
-                    for row in content:
-                        response += row + "\n"
-                    await update.message.reply_text(response)
-                else:
-                    await update.message.reply_text('Failed to read the file content. Please try again.')
-                return
-    if command == "/remove":
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as response:
-                if response.status == 200:
-                    content = remove_cards_from_file(db_name,table_name, await response.text())
-                    response = ""
-                    for row in content:
-                        response += row + "\n"
-                    await update.message.reply_text(response)
-                else:
-                    await update.message.reply_text('Failed to read the file content. Please try again.')
-                return
-    if command == "/add_diff":
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as response:
-                if response.status == 200:
-                    content = add_diff(db_name,table_name, await response.text())
-                    response = ""
-                    for row in content:
-                        response += row + "\n"
-                    await update.message.reply_text(response)
-                else:
-                    await update.message.reply_text('Failed to read the file content. Please try again.')
+    mime_types = UPLOAD_MIME_TYPES + ARCHIVE_MIME_TYPES if command == "/allocate" else UPLOAD_MIME_TYPES
+    if file.mime_type not in mime_types:  # Ensure it's a text or CSV file
+        await update.message.reply_text('Please upload a valid text file.')
+        return
+    try:
+        check_download_size(file.file_size)
+    except ValueError as e:
+        await update.message.reply_text(f"An error occurred: {e}")
+        return
+    # Accept the file right away, it is downloaded and processed by a background job
+    status = await update.message.reply_text(f"Queued {file.file_name or 'the file'}, progress will be shown here.")
+    try:
+        context.bot_data["jobs"].submit(update.message.from_user.id, command, lambda: process_upload(update, context, command, file, status))
+    except TooManyJobs as e:
+        await status.edit_text(f"Not queued: {e}.")
+
+async def process_upload(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str, file, status) -> None:
+    progress = Progress(status, file.file_size)
+    await progress.edit("Processing...")
+
+    # Stream the file without saving it locally, it is parsed as it arrives
+    session = context.bot_data["http_session"]
+    try:
+        if command.__contains__("/compare") and await send_cached_compare(update, context, command, file, progress):
+            return
+        new_file = await context.bot.get_file(file.file_id)
+        async with session.get(new_file.file_path) as response:
+            if response.status != 200:
+                await progress.finish('Failed to read the file content. Please try again.')
                 return
+            try:
+                if command.__contains__("/compare"):
+                    await compare_upload(update, context, command, file, response, progress)
+                elif command == "/add":
+                    content = await stream_into(collection(update), response, bulk_add, command, progress)
+                    await progress.finish()
+                    await send_rows(update, content if content else ["No cards added."])
+                elif command == "/remove":
+                    content = await stream_into(collection(update), response, bulk_remove, command, progress)
+                    await progress.finish()
+                    await send_rows(update, content if content else ["No cards removed."])
+                elif command == "/add_diff":
+                    await add_diff_upload(update, response, progress)
+                elif command == "/import":
+                    await import_upload(update, response, progress)
+                elif command == "/allocate":
+                    await allocate_upload(update, file, response, progress)
+            except ValueError as e:
+                # The whole file is parsed before anything is written
+                await progress.finish("Nothing was changed, the file has an invalid line.")
+                await update.message.reply_text(f"An error occurred: {e}")
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        await progress.finish('Failed to read the file content. Please try again.')
+    except Exception:
+        # Logged by the job queue, do not leave the status message hanging
+        await progress.finish(f"Failed after {progress.lines} lines, please try again.")
+        raise
+
+async def read_cards(response, command: str, progress: Progress) -> list:
+    # Parse the whole file first, so a bad line is reported before anything is written.
+    # The (name, quantity) tuples are small and the download is capped at MAX_DOWNLOAD_BYTES
+    cards = []
+    async for batch in iter_batches(response, command=command, on_chunk=progress.add_bytes):
+        cards += batch
+        await progress.update(len(batch))
+    return cards
+
+async def stream_into(db_name: str, response, bulk_function, command: str, progress: Progress) -> list:
+    # One writer call, so the whole file is applied in a single transaction or not at all
+    cards = await read_cards(response, command, progress)
+    if not cards:
+        return []
+    return await run_write(bulk_function, db_name, table_name, cards)
+
+async def compare_upload(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str, file, response, progress: Progress) -> None:
+    # Compared as a whole, so a repeated upload of the same decklist is served from the compare cache
+    cards = await read_cards(response, command, progress)
+    db_name = collection(update)
+    key, content, entry = await run_read(compare_entry, db_name, table_name, column_name, cards)
+    get_results().remember_upload(file.file_unique_id, key[2])
+    await progress.finish()
+    await send_compare(update, context, command, content, entry)
+
+async def send_cached_compare(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str, file, progress: Progress) -> bool:
+    # The same file was compared before and the inventory has not changed since: skip the download
+    digest = get_results().upload_digest(file.file_unique_id)
+    if digest is None:
+        return False
+    key = await run_read(compare_version_key, collection(update), table_name, digest)
+    entry = get_results().get(key)
+    if entry is None:
+        return False
+    await progress.finish("Unchanged since the last compare of this file.")
+    await send_compare(update, context, command, list(entry.rows), entry)
+    return True
+
+async def send_compare(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str, content: list, entry=None) -> None:
+    if command.__contains__("file"):
+        await send_rows(update, [format_compare_row(row) for row in content] or ["No matches found."], filename="compare.txt")
+        return
+    if entry is not None and entry.document_id:
+        # Telegram still has the diff.txt sent for this result
+        await context.bot.send_document(chat_id=update.message.chat_id, document=entry.document_id)
+        return
+    response = ""
+    for row in content:
+        if row.needed > 0:
+            response += f"{row.needed} {row.name}\n".replace('"','')
+    # Built in memory, compare jobs run side by side and must not share a file
+    document = io.BytesIO(response.encode("utf-8"))
+    message = await context.bot.send_document(chat_id=update.message.chat_id, document=document, filename="diff.txt")
+    if entry is not None and message.document:
+        entry.document_id = message.document.file_id
+
+async def add_diff_upload(update: Update, response, progress: Progress) -> None:
+    cards = await read_cards(response, "/add_diff", progress)
+    total = len(cards)
+    content, owned = await run_write(bulk_add_diff, collection(update), table_name, cards) if cards else ([], 0)
+    await progress.finish()
+    if content:
+        await send_rows(update, content)
+    elif total and owned == total:
+        await update.message.reply_text("You already own every card in the file.")
     else:
-        await update.message.reply_text('Please provide a valid command.')
+        await update.message.reply_text("No differences added.")
+
+async def import_upload(update: Update, response, progress: Progress) -> None:
+    # The whole file is loaded in one transaction, so it is read first (at most MAX_DOWNLOAD_BYTES)
+    lines = [line async for line in iter_lines(response, command="/import", on_chunk=progress.add_bytes)]
+    try:
+        count, seconds = await run_write(import_inventory, collection(update), table_name, lines)
+    except ValueError as e:
+        # load_rows rolls the whole file back
+        await progress.finish("Nothing was imported, the file has an invalid row.")
+        await update.message.reply_text(f"An error occurred: {e}")
+        return
+    await progress.finish()
+    rate = count / seconds if seconds else count
+    await update.message.reply_text(f"Imported {count} rows in {seconds:.2f} s ({rate:.0f} rows/s).")
+
+def collect_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Documents sent together only share a media_group_id, and the caption is on one of them
+    groups = context.bot_data.setdefault("media_groups", {})
+    group_id = update.message.media_group_id
+    if group_id not in groups:
+        groups[group_id] = []
+        context.application.create_task(flush_media_group(context, group_id))
+    groups[group_id].append(update)
+
+async def flush_media_group(context: ContextTypes.DEFAULT_TYPE, group_id: str) -> None:
+    await asyncio.sleep(MEDIA_GROUP_WAIT)
+    updates = context.bot_data["media_groups"].pop(group_id)
+    commands = {word for item in updates for word in (item.message.caption or "").split()[:1]}
+    if "/allocate" in commands:
+        await accept_allocation(updates, context)
+        return
+    # Not an allocation, every document is handled on its own
+    for update in updates:
+        await accept_upload(update, context)
+
+async def accept_allocation(updates: list, context: ContextTypes.DEFAULT_TYPE) -> None:
+    update = updates[0]
+    files = [item.message.document for item in updates]
+    if any(file.mime_type not in UPLOAD_MIME_TYPES for file in files):
+        await update.message.reply_text('Please upload valid text files, or a single zip archive of them.')
+        return
+    try:
+        check_download_size(sum(file.file_size or 0 for file in files))
+    except ValueError as e:
+        await update.message.reply_text(f"An error occurred: {e}")
         return
+    status = await update.message.reply_text(f"Queued {len(files)} decklists, progress will be shown here.")
+    try:
+        context.bot_data["jobs"].submit(update.message.from_user.id, "/allocate", lambda: process_allocation(update, context, files, status))
+    except TooManyJobs as e:
+        await status.edit_text(f"Not queued: {e}.")
+
+async def process_allocation(update: Update, context: ContextTypes.DEFAULT_TYPE, files: list, status) -> None:
+    progress = Progress(status, sum(file.file_size or 0 for file in files))
+    await progress.edit("Processing...")
+
+    session = context.bot_data["http_session"]
+    decks = []
+    try:
+        for file in files:
+            new_file = await context.bot.get_file(file.file_id)
+            async with session.get(new_file.file_path) as response:
+                if response.status != 200:
+                    await progress.finish('Failed to read the file content. Please try again.')
+                    return
+                try:
+                    cards = await read_cards(response, "/allocate", progress)
+                except ValueError as e:
+                    await progress.finish(f"Stopped after {progress.lines} lines.")
+                    await update.message.reply_text(f"An error occurred in {file.file_name or 'a file'}: {e}")
+                    return
+            decks.append((deck_name(file, len(decks) + 1), cards))
+        await send_allocation(update, decks, progress)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        await progress.finish('Failed to read the file content. Please try again.')
+    except Exception:
+        await progress.finish(f"Failed after {progress.lines} lines, please try again.")
+        raise
+
+async def allocate_upload(update: Update, file, response, progress: Progress) -> None:
+    if file.mime_type in ARCHIVE_MIME_TYPES:
+        data = await read_body(response, command="/allocate", on_chunk=progress.add_bytes)
+        decks = await asyncio.to_thread(read_decklist_archive, data)
+    else:
+        decks = [(deck_name(file, 1), await read_cards(response, "/allocate", progress))]
+    await send_allocation(update, decks, progress)
+
+async def send_allocation(update: Update, decks: list, progress: Progress) -> None:
+    # Every deck in one query, they share the inventory in the order they were sent
+    seen = {}
+    named = []
+    for name, cards in decks:
+        seen[name] = seen.get(name, 0) + 1
+        named.append((name if seen[name] == 1 else f"{name} ({seen[name]})", cards))
+    rows = await run_read(allocate_decklists, collection(update), table_name, named)
+    await progress.finish()
+    await send_rows(update, format_allocation(rows) or ["No cards found."], filename="allocation.txt")
+
+def deck_name(file, number: int) -> str:
+    if file.file_name:
+        return os.path.splitext(file.file_name)[0]
+    return f"Deck {number}"
 
 async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:#???
     context.args = update.message.text.split()[1:]
@@ -202,23 +394,75 @@ async def return_inv_file(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text('You are not authorized to use this bot.')
         return
 
-    # Generate the inventory file
-    response = return_inventory_file(db_name, table_name, "./")
+    # Optional arguments: the line format (csv or mtgo) and gz to compress
+    export_format = "csv"
+    compress = False
+    for arg in context.args:
+        if arg in EXPORT_FORMATS:
+            export_format = arg
+        elif arg == "gz":
+            compress = True
+        else:
+            await update.message.reply_text(f"Unknown option '{arg}'. Use /return_inv_file [{'|'.join(EXPORT_FORMATS)}] [gz]")
+            return
+
+    # Generate the inventory in memory
+    document, count = await run_read(export_inventory, collection(update), table_name, export_format, compress)
 
     # Send the file to the user
-    if os.path.exists(response):
-        await context.bot.send_document(chat_id=update.message.chat_id, document=open(response, 'rb'))
-        await update.message.reply_text('Inventory file has been sent.')
+    if count:
+        filename = "inventory.txt.gz" if compress else "inventory.txt"
+        await context.bot.send_document(chat_id=update.message.chat_id, document=document, filename=filename)
+        await update.message.reply_text(f'Inventory file has been sent ({count} cards).')
     else:
-        await update.message.reply_text('Failed to generate the inventory file.')
+        await update.message.reply_text('No inventory to write.')
+
+async def snapshot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not loggingAuth("snapshot", update.message.from_user.id, update.message.from_user.first_name, check_user(update, context)):
+        await update.message.reply_text('You are not authorized to use this bot.')
+        return
+    query = ' '.join(context.args)
+    if not query or query.isdigit():
+        await update.message.reply_text('Please provide a snapshot name (not a number).')
+        return
+    version = await run_write(create_snapshot, collection(update), table_name, query)
+    await update.message.reply_text(f"Snapshot '{query}' saved at version {version}.")
 
-    os.remove(response)
+async def changes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not loggingAuth("changes", update.message.from_user.id, update.message.from_user.first_name, check_user(update, context)):
+        await update.message.reply_text('You are not authorized to use this bot.')
+        return
+    if not context.args:
+        version = await run_read(inventory_version, collection(update), table_name)
+        await update.message.reply_text(f"The inventory is at version {version}. Use /changes <version|snapshot> [csv|mtgo] to get what changed since then.")
+        return
+    export_format = context.args[1] if len(context.args) > 1 else "csv"
+    if export_format not in EXPORT_FORMATS:
+        await update.message.reply_text(f"Unknown format '{export_format}'. Use one of: {', '.join(EXPORT_FORMATS)}")
+        return
+    try:
+        document, since, version, count = await run_read(export_changes, collection(update), table_name, context.args[0], export_format)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    if not count:
+        await update.message.reply_text(f"No changes since version {since} (now at version {version}).")
+        return
+    # Quantities are the current ones, 0 means the card was removed
+    await context.bot.send_document(chat_id=update.message.chat_id, document=document, filename=f"changes_{since}_{version}.txt",
+                                    caption=f"{count} cards changed since version {since} (now at version {version}).")
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not loggingAuth("stats", update.message.from_user.id, update.message.from_user.first_name, check_user(update, context)):
+        await update.message.reply_text('You are not authorized to use this bot.')
+        return
+    await send_rows(update, format_stats(), filename="stats.txt")
 
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not loggingAuth("help", update.message.from_user.id, update.message.from_user.first_name, check_user(update, context)):
         await update.message.reply_text('You are not authorized to use this bot.')
         return
-    await update.message.reply_text('Use /search <query> to search.\nUse /add <query> to add a card.\nUse /remove <query> to remove a card.\nUse /compare <query> to compare a card.\nUse /remove_all all to remove all cards or all istances of a card by adding the card name.\nUse /return_inv_file to get the inventory file.\nUse /remove while sending an attached file to remove the contents of the file form the inventory.\nUse /compare while sending an attached file to get the car that are present in the file but not in the inventory.\nUse /add while sending an attached file to add the cards present in the sent file.')
+    await update.message.reply_text('Use /search <query> to search.\nUse /add <query> to add a card.\nUse /remove <query> to remove a card.\nUse /compare <query> to compare a card.\nUse /remove_all all to remove all cards or all istances of a card by adding the card name.\nUse /return_inv_file [csv|mtgo] [gz] to get the inventory file.\nUse /snapshot <name> to name the current inventory version.\nUse /changes <version|snapshot> [csv|mtgo] to get only the cards that changed since then.\nUse /stats to see how long each command takes.\nUse /remove while sending an attached file to remove the contents of the file form the inventory.\nUse /compare while sending an attached file to get the car that are present in the file but not in the inventory.\nUse /add while sending an attached file to add the cards present in the sent file.\nUse /import while sending a CSV collection export to bulk load it into the inventory.\nUse /allocate while sending several decklists (as a zip or together in one message) to see what all of them need when they share the inventory.\nFiles can list cards as "name, N", as "N name" or as a CSV with a header row.')
 
 # Utility functions
 def get_env_variable(name: str) -> str:
@@ -238,41 +482,119 @@ def check_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 def load_ids() -> None:
     # Load the authorized user IDs from the environment
-    global authorized_users
+    global authorized_users, legacy_owner
     authorized_users = list(map(int, get_env_variable("AUTHORIZED_USERS").split(',')))
+    # data.db stays with the first authorized user unless LEGACY_OWNER says otherwise
+    legacy_owner = int(os.environ.get("LEGACY_OWNER", authorized_users[0]))
+
+def collection(update: Update) -> str:
+    # Every private chat has its own collection, members of a group share the group's
+    return collection_for(update.message.chat_id, legacy_owner)
 
-def create_file(file_path: str, content: str) -> None:
-    # Create a file with the given content
-    with open(file_path, 'w') as file:
-        file.write(content)
+async def check_caches_periodically(interval: float = CACHE_CHECK_INTERVAL) -> None:
+    # Safety net behind the change log check of get_cache: compare every open cache with its database
+    while True:
+        await asyncio.sleep(interval)
+        for db_name in open_shards():
+            mismatches = await run_write(check_cache, db_name, table_name)
+            if mismatches:
+                logging.warning(f"Inventory cache of {db_name} had {mismatches} stale cards, reloaded")
+
+async def on_startup(application: Application) -> None:
+    # One HTTP session for every file download, so connections are reused
+    application.bot_data["http_session"] = create_session()
+    # Uploads are processed in the background, a few at a time
+    application.bot_data["jobs"] = JobQueue()
+    # Build the fuzzy name index and the inventory cache of the main collection now rather than on the first lookup
+    if legacy_owner is not None:
+        await run_read(get_index, collection_for(legacy_owner, legacy_owner), table_name)
+        await run_read(get_cache, collection_for(legacy_owner, legacy_owner), table_name)
+    if CACHE_CHECK_INTERVAL > 0:
+        application.bot_data["cache_check"] = asyncio.create_task(check_caches_periodically())
+    # Optional Prometheus-style exports of the metrics
+    if metrics.METRICS_FILE:
+        application.bot_data["metrics_dump"] = asyncio.create_task(metrics.dump_periodically(metrics.METRICS_FILE))
+    if metrics.METRICS_PORT:
+        application.bot_data["metrics_server"] = await metrics.start_server()
+
+async def on_shutdown(application: Application) -> None:
+    # Stop the upload jobs before the session they download with
+    jobs = application.bot_data.pop("jobs", None)
+    if jobs is not None:
+        await jobs.shutdown()
+    session = application.bot_data.pop("http_session", None)
+    if session is not None:
+        await session.close()
+    cache_check = application.bot_data.pop("cache_check", None)
+    if cache_check is not None:
+        cache_check.cancel()
+    dump = application.bot_data.pop("metrics_dump", None)
+    if dump is not None:
+        dump.cancel()
+        metrics.write_prometheus(metrics.METRICS_FILE)
+    server = application.bot_data.pop("metrics_server", None)
+    if server is not None:
+        await server.cleanup()
 
 # Main function
 def main() -> None:
     # Load the authorized user IDs
     load_ids()
+    # polling (default) or webhook, see webhook.py for its settings
+    mode = os.environ.get("BOT_MODE", "polling")
+    if mode not in ("polling", "webhook"):
+        raise Exception(f"Unknown BOT_MODE '{mode}', expected 'polling' or 'webhook'.")
     # Create the Application and pass it your bot's token
-    application = Application.builder().token(get_env_variable("TG_API")).build()
+    builder = (
+        Application.builder()
+        .token(get_env_variable("TG_API"))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        # Polled or pushed, updates are handled side by side instead of one after the other
+        .concurrent_updates(CONCURRENT_UPDATES)
+    )
+    application = builder.build()
 
     # Register command handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("search", search))
-    application.add_handler(CommandHandler("add", add))
-    application.add_handler(CommandHandler("remove", remove))
-    application.add_handler(CommandHandler("compare", compare))
-    application.add_handler(CommandHandler("remove_all", remove_all))
-    application.add_handler(CommandHandler("return_inv_file", return_inv_file))
-    application.add_handler(CommandHandler("help", help))
+    # Every handler is timed, see /stats
+    commands = {
+        "start": start,
+        "search": search,
+        "add": add,
+        "remove": remove,
+        "compare": compare,
+        "remove_all": remove_all,
+        "return_inv_file": return_inv_file,
+        "snapshot": snapshot,
+        "changes": changes,
+        "stats": stats,
+        "help": help,
+    }
+    # /add and /remove never hold up the next update, so commands arriving together
+    # can share a transaction (see coalesce.py)
+    non_blocking = ("add", "remove")
+    for command, handler in commands.items():
+        application.add_handler(CommandHandler(command, timed_command(command, handler), block=command not in non_blocking))
     
     
     # Register a message handler to handle file uploads
-    application.add_handler(MessageHandler(filters.Document.ALL, handle_file_upload))
+    application.add_handler(MessageHandler(filters.Document.ALL, timed_command("file_upload", handle_file_upload)))
     #application.add_handler(MessageHandler(filters=[filters.Document.ALL,filters.Command], ))
     
     # Start the Bot
-    print("Polling...")
-    application.run_polling()
+    try:
+        if mode == "webhook":
+            print("Serving webhook...")
+            webhook.run(application)
+        else:
+            print("Polling...")
+            application.run_polling()
+    finally:
+        # Let queued database work finish, then release the pooled connections
+        async_db.shutdown()
+        close_all()
     
     
 if __name__ == '__main__':
-    subprocess.run(["python", "createDB.py"])
+    # The database schema is created or upgraded when the first connection opens
     main()
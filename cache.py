@@ -0,0 +1,219 @@
+import os
+import threading
+from collections import OrderedDict
+
+from db import add_write_listener, connection
+from schema import change_version
+
+
+# Most cards kept in memory per inventory, least recently used ones are evicted first
+MAX_ENTRIES = int(os.environ.get("INVENTORY_CACHE_SIZE", "100000"))
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class InventoryCache:
+    """
+    An in-memory copy of an inventory's name -> quantity mapping.
+
+    Keys are lowercase card names. Every committed mutation is written through,
+    and each one bumps `version`, so a reader that filled the cache from the
+    database can tell whether a write happened in between. While the whole
+    table fits (`complete`), a miss means the card is not owned.
+
+    `change_version` is the change log version the entries reflect. When the
+    database is ahead of it, something wrote without going through sql.py
+    (e.g. createDB.py --shared) and get_cache reloads.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.version = 0
+        self.complete = False
+        self.change_version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self, conn, table_name: str) -> None:
+        """
+        Fill the cache from the database, up to `max_entries` cards.
+        """
+        # Read first: a write landing in between only makes the next check reload again
+        loaded_version = change_version(conn, table_name)
+        cursor = conn.execute(f"SELECT name, quantity FROM {table_name}")
+        entries = OrderedDict()
+        complete = True
+        for name, quantity in cursor:
+            if len(entries) >= self.max_entries:
+                complete = False
+                break
+            entries[name.lower()] = quantity
+        cursor.close()
+
+        with self._lock:
+            self._entries = entries
+            self.complete = complete
+            self.change_version = loaded_version
+            self.version += 1
+
+    def lookup(self, names) -> tuple:
+        """
+        Look cards up without touching the database.
+
+        :param names: The card names to look up.
+        :return: A dict of lowercase name -> quantity (0 when not owned) for the
+                 names the cache can answer, and a list of the names it cannot.
+        """
+        known = {}
+        unknown = []
+        with self._lock:
+            for name in names:
+                key = name.lower()
+                if key in known:
+                    continue
+                quantity = self._entries.get(key)
+                if quantity is not None:
+                    self._entries.move_to_end(key)
+                    known[key] = quantity
+                elif self.complete:
+                    known[key] = 0
+                else:
+                    unknown.append(key)
+        return known, unknown
+
+    def fill(self, names, quantities: dict, version: int) -> None:
+        """
+        Store quantities read from the database (read-through).
+
+        Skipped when a write happened since `version` was read, as the values may be stale.
+
+        :param names: The lowercase names that were looked up.
+        :param quantities: The quantities found, names missing from it are not owned.
+        :param version: The cache version read before querying the database.
+        """
+        with self._lock:
+            if version != self.version:
+                return
+            for name in names:
+                self._set(name, quantities.get(name, 0))
+
+    def apply(self, changes: dict, change_version: int = None) -> None:
+        """
+        Write committed changes through to the cache.
+
+        :param changes: A dict mapping card names to their new quantity (0 or less means deleted).
+        :param change_version: The change log version after the write.
+        """
+        with self._lock:
+            for name, quantity in changes.items():
+                self._set(name.lower(), max(quantity, 0))
+            if change_version is not None:
+                self.change_version = max(change_version, self.change_version or 0)
+            self.version += 1
+
+    def _set(self, key: str, quantity: int) -> None:
+        # While complete, absent cards need no entry at all
+        if quantity == 0 and self.complete:
+            self._entries.pop(key, None)
+            return
+        self._entries[key] = quantity
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.complete = False
+
+    def verify(self, conn, table_name: str) -> list:
+        """
+        Compare the cache against the database.
+
+        :return: A list of (name, cached, stored) tuples that disagree.
+        """
+        with self._lock:
+            entries = dict(self._entries)
+            complete = self.complete
+
+        mismatches = []
+        stored = {name.lower(): quantity for name, quantity in conn.execute(f"SELECT name, quantity FROM {table_name}")}
+        for name, cached in entries.items():
+            if stored.get(name, 0) != cached:
+                mismatches.append((name, cached, stored.get(name, 0)))
+        if complete:
+            for name, quantity in stored.items():
+                if name not in entries:
+                    mismatches.append((name, 0, quantity))
+        return mismatches
+
+
+def get_cache(db_name: str, table_name: str, version: int = None) -> InventoryCache:
+    """
+    Return the inventory cache of a table, loading it on first use.
+
+    A cache that is behind the change log is reloaded, which costs one indexed
+    read per call while nothing changed.
+
+    :param db_name: The SQLite database file name (e.g., 'data.db').
+    :param table_name: The name of the cached table (e.g., 'cards').
+    :param version: The change log version the caller already read, saves reading it again.
+    """
+    cache = _caches.get((db_name, table_name))
+    if cache is not None:
+        if version is not None and version <= (cache.change_version or 0):
+            return cache
+        with connection(db_name) as conn:
+            if change_version(conn, table_name) > (cache.change_version or 0):
+                cache.load(conn, table_name)
+        return cache
+
+    with _caches_lock:
+        cache = _caches.get((db_name, table_name))
+        if cache is None:
+            cache = InventoryCache()
+            with connection(db_name) as conn:
+                cache.load(conn, table_name)
+            _caches[(db_name, table_name)] = cache
+    return cache
+
+
+def check_cache(db_name: str, table_name: str) -> int:
+    """
+    Verify a loaded cache against the database and reload it if they disagree.
+    Run it on the writer thread (async_db.run_write) so no write lands in between.
+
+    :param db_name: The SQLite database file name (e.g., 'data.db').
+    :param table_name: The name of the cached table (e.g., 'cards').
+    :return: The number of mismatched cards that were found.
+    """
+    cache = _caches.get((db_name, table_name))
+    if cache is None:
+        return 0
+    with connection(db_name) as conn:
+        mismatches = cache.verify(conn, table_name)
+        if mismatches:
+            cache.load(conn, table_name)
+    return len(mismatches)
+
+
+def drop_cache(db_name: str, table_name: str) -> None:
+    """
+    Forget the inventory cache of a table, it is loaded again on next use.
+    """
+    _caches.pop((db_name, table_name), None)
+
+
+def _on_write(db_name: str, table_name: str, changes: dict) -> None:
+    cache = _caches.get((db_name, table_name))
+    if cache is None:
+        return
+    with connection(db_name) as conn:
+        if changes is None:
+            # The whole table changed, start over from the database
+            cache.load(conn, table_name)
+        else:
+            cache.apply(changes, change_version(conn, table_name))
+
+
+add_write_listener(_on_write)
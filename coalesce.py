@@ -0,0 +1,103 @@
+import asyncio
+
+from async_db import run_write
+from sql import QUERY_FORMAT_ERROR, apply_card_changes, parse_card_query
+
+
+# Seconds a single-card change waits for others to share its transaction
+COALESCE_WINDOW = 0.005
+
+# Changes applied per transaction at most; a full batch is written right away
+MAX_BATCH = 256
+
+_coalescers = {}
+
+
+class WriteCoalescer:
+    """
+    Groups single-card /add and /remove commands on one inventory into shared transactions.
+
+    Changes queue up for COALESCE_WINDOW seconds, and for as long as the
+    previous batch is still being written, then are applied in arrival order
+    by sql.apply_card_changes. Each caller still gets its own reply.
+    Must be used from inside the running event loop.
+    """
+
+    def __init__(self, db_name: str, table_name: str, window: float = COALESCE_WINDOW, max_batch: int = MAX_BATCH):
+        self.db_name = db_name
+        self.table_name = table_name
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []  # (operation, name, quantity, future)
+        self._full = asyncio.Event()
+        self._flusher = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def submit(self, operation: str, name: str, quantity: int) -> str:
+        """
+        Queue a change and wait until it is committed.
+
+        :param operation: 'add' or 'remove'.
+        :param name: The card name.
+        :param quantity: The quantity to add or subtract.
+        :return: The same reply add_or_update_quantity or subtract_quantity would give.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((operation, name, quantity, future))
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush())
+        return await future
+
+    async def _flush(self) -> None:
+        while self._pending:
+            # Give concurrent commands a moment to join the batch
+            try:
+                await asyncio.wait_for(self._full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            if len(self._pending) < self.max_batch:
+                self._full.clear()
+
+            changes = [(operation, name, quantity) for operation, name, quantity, _ in batch]
+            try:
+                replies = await run_write(apply_card_changes, self.db_name, self.table_name, changes)
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (*_, future), reply in zip(batch, replies):
+                if not future.done():
+                    future.set_result(reply)
+
+        # Nothing left, forget this inventory until its next command
+        if _coalescers.get((self.db_name, self.table_name)) is self:
+            del _coalescers[(self.db_name, self.table_name)]
+
+
+async def change_card(db_name: str, table_name: str, operation: str, query: str) -> str:
+    """
+    Apply a single-card /add or /remove query through the coalescer of its inventory.
+
+    :param db_name: The SQLite database file name (e.g., 'data.db').
+    :param table_name: The name of the table to update (e.g., 'cards').
+    :param operation: 'add' or 'remove'.
+    :param query: The command argument, e.g. 'Sakura-Tribe Elder, 2'.
+    :return: The reply to send back.
+    """
+    try:
+        name, quantity = parse_card_query(query)
+    except ValueError:
+        return QUERY_FORMAT_ERROR
+
+    coalescer = _coalescers.get((db_name, table_name))
+    if coalescer is None:
+        coalescer = _coalescers[(db_name, table_name)] = WriteCoalescer(db_name, table_name)
+    return await coalescer.submit(operation, name, quantity)
@@ -0,0 +1,157 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from db import add_write_listener
+
+
+# Compare results kept in memory across all inventories, least recently used ones are evicted first
+MAX_RESULTS = int(os.environ.get("COMPARE_CACHE_SIZE", "256"))
+
+# Uploaded files whose decklist digest is remembered, so a re-sent file needs no download
+MAX_UPLOADS = int(os.environ.get("COMPARE_UPLOAD_CACHE_SIZE", "1024"))
+
+
+def decklist_digest(cards) -> str:
+    """
+    Hash a parsed decklist.
+
+    Parsing already normalizes the file format, so "2 Sol Ring" and "Sol Ring, 2"
+    hash the same. Names keep their case, it shows in the reply.
+
+    :param cards: A list of (name, quantity) tuples, see decklist.parse_decklist.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name, quantity in cards:
+        digest.update(f"{name.strip()}\t{quantity}\n".encode())
+    return digest.hexdigest()
+
+
+class CompareEntry:
+    """
+    A memoized compare: the rows, and the Telegram file id of the diff.txt once it was sent.
+    """
+
+    __slots__ = ("rows", "document_id")
+
+    def __init__(self, rows):
+        self.rows = tuple(rows)
+        self.document_id = None
+
+
+class CompareCache:
+    """
+    Compare results keyed by (db_name, table_name, decklist digest, inventory version).
+
+    The inventory version is the change log version (schema.change_version),
+    read once per compare. sql.compare_entry only stores rows built from an
+    inventory cache at that same version, so a result is never served for an
+    inventory it was not computed against, whoever wrote to it.
+    Writes through sql.py also drop the results of their inventory right away
+    (see _on_write), they could not be hit anymore, and bump its generation so
+    a compare that was running meanwhile does not store what it read.
+    """
+
+    def __init__(self, max_results: int = MAX_RESULTS, max_uploads: int = MAX_UPLOADS):
+        self.max_results = max_results
+        self.max_uploads = max_uploads
+        self._results = OrderedDict()
+        self._uploads = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def get(self, key: tuple) -> CompareEntry:
+        """
+        :param key: (db_name, table_name, decklist digest, inventory version).
+        :return: The cached entry, or None.
+        """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                self._results.move_to_end(key)
+            return entry
+
+    def generation(self, db_name: str, table_name: str) -> int:
+        """
+        Return the number of times an inventory was invalidated, read it before comparing.
+        """
+        return self._generations.get((db_name, table_name), 0)
+
+    def put(self, key: tuple, rows, generation: int) -> CompareEntry:
+        """
+        Store the rows of a compare, evicting the least recently used results over max_results.
+
+        Skipped when the inventory was written to since `generation` was read, as the rows may be stale.
+
+        :return: The new entry, or None when skipped.
+        """
+        entry = CompareEntry(rows)
+        with self._lock:
+            if generation != self._generations.get(key[:2], 0):
+                return None
+            self._results[key] = entry
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return entry
+
+    def remember_upload(self, file_unique_id: str, digest: str) -> None:
+        """
+        Remember the decklist digest of an uploaded file.
+
+        :param file_unique_id: Telegram's id of the file content, the same for every re-send.
+        :param digest: The decklist_digest of its parsed content.
+        """
+        with self._lock:
+            self._uploads[file_unique_id] = digest
+            self._uploads.move_to_end(file_unique_id)
+            while len(self._uploads) > self.max_uploads:
+                self._uploads.popitem(last=False)
+
+    def upload_digest(self, file_unique_id: str) -> str:
+        """
+        Return the decklist digest of a file seen before, or None.
+        """
+        with self._lock:
+            return self._uploads.get(file_unique_id)
+
+    def invalidate(self, db_name: str, table_name: str) -> int:
+        """
+        Drop every result computed against an inventory.
+
+        :return: The number of results dropped.
+        """
+        with self._lock:
+            self._generations[(db_name, table_name)] = self._generations.get((db_name, table_name), 0) + 1
+            stale = [key for key in self._results if key[0] == db_name and key[1] == table_name]
+            for key in stale:
+                del self._results[key]
+        return len(stale)
+
+
+_results = CompareCache()
+
+
+def get_results() -> CompareCache:
+    """
+    Return the compare result cache shared by every inventory.
+    """
+    return _results
+
+
+def drop_results(db_name: str, table_name: str) -> None:
+    """
+    Forget the compare results of an inventory.
+    """
+    _results.invalidate(db_name, table_name)
+
+
+def _on_write(db_name: str, table_name: str, changes: dict) -> None:
+    _results.invalidate(db_name, table_name)
+
+
+add_write_listener(_on_write)
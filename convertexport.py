@@ -1,38 +1,136 @@
-import tkinter as tk
-from tkinter import filedialog
+"""
+Convert exported decklists to the "name, quantity" format the bot reads.
+
+The input format ("2 Card Name", "Card Name, 2" or a CSV file with a header
+row like data.csv) is detected per file. Directories are converted file by
+file on a pool of processes:
+
+    python convertexport.py deck.txt
+    python convertexport.py exports/ --output converted/ --workers 8
+
+Each input is written next to it as <name>_converted.txt unless --output is given.
+"""
+import argparse
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from decklist import DECKLIST_FORMATS, format_line, iter_decklist
+
+
+# Files picked up when a directory is given
+INPUT_EXTENSIONS = (".txt", ".csv")
+
+# Suffix of the converted files, they are skipped when converting a directory again
+CONVERTED_SUFFIX = "_converted.txt"
+
+
+def convert_file(input_file: str, output_file: str, decklist_format: str = None) -> int:
+    """
+    Convert one decklist, reading and writing it line by line.
+
+    :param input_file: The path of the decklist to convert.
+    :param output_file: The path of the "name, quantity" file to write.
+    :param decklist_format: One of decklist.DECKLIST_FORMATS, detected when None.
+    :return: The number of cards written.
+    :raises ValueError: If a line cannot be parsed, with its line number.
+    """
+    count = 0
+    # utf-8-sig drops the BOM Windows editors like to add
+    with open(input_file, "r", encoding="utf-8-sig", newline="") as infile, \
+            open(output_file, "w", encoding="utf-8") as outfile:
+        for name, quantity in iter_decklist(infile, decklist_format):
+            outfile.write(format_line(name, quantity) + "\n")
+            count += 1
+    return count
+
+
+def output_path(input_file: str, output_directory: str = None) -> str:
+    """
+    Return where the converted copy of a file goes.
+    """
+    stem = os.path.splitext(os.path.basename(input_file))[0]
+    directory = output_directory if output_directory is not None else os.path.dirname(input_file)
+    return os.path.join(directory, stem + CONVERTED_SUFFIX)
+
+
+def find_inputs(paths) -> list:
+    """
+    Expand directories into the decklist files they contain.
+
+    :param paths: Files and directories given on the command line.
+    :return: The files to convert, directories sorted by name.
+    """
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for entry in sorted(os.listdir(path)):
+                full_path = os.path.join(path, entry)
+                if (os.path.isfile(full_path) and entry.lower().endswith(INPUT_EXTENSIONS)
+                        and not entry.endswith(CONVERTED_SUFFIX)):
+                    inputs.append(full_path)
+        else:
+            inputs.append(path)
+    return inputs
+
+
+def _convert(job) -> tuple:
+    # Runs in a worker process, errors are returned rather than raised so one
+    # bad file does not stop the others
+    input_file, output_file, decklist_format = job
+    try:
+        return input_file, output_file, convert_file(input_file, output_file, decklist_format), None
+    except (OSError, ValueError) as e:
+        # Do not leave a half written file behind
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        return input_file, output_file, 0, str(e)
+
+
+def convert_paths(paths, output_directory: str = None, decklist_format: str = None, workers: int = None):
+    """
+    Convert files and whole directories, in parallel when there is more than one file.
+
+    :param paths: Files and directories to convert.
+    :param output_directory: Where to write the converted files, next to each input when None.
+    :param decklist_format: One of decklist.DECKLIST_FORMATS, detected per file when None.
+    :param workers: Number of worker processes, one per CPU when None.
+    :return: A generator of (input, output, cards written, error or None) tuples, in input order.
+    """
+    if output_directory is not None:
+        os.makedirs(output_directory, exist_ok=True)
+
+    jobs = [(path, output_path(path, output_directory), decklist_format) for path in find_inputs(paths)]
+    if len(jobs) <= 1 or workers == 1:
+        yield from map(_convert, jobs)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Large chunks keep the inter-process overhead low for hundreds of small files
+        chunk_size = max(len(jobs) // ((workers or os.cpu_count() or 1) * 4), 1)
+        yield from pool.map(_convert, jobs, chunksize=chunk_size)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Convert exported decklists to the 'name, quantity' format.")
+    parser.add_argument("paths", nargs="+", help="decklist files or directories of them")
+    parser.add_argument("-o", "--output", help="directory for the converted files (default: next to each input)")
+    parser.add_argument("-f", "--format", choices=DECKLIST_FORMATS, help="input format (default: detected per file)")
+    parser.add_argument("-w", "--workers", type=int, help="worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    converted = failed = 0
+    for input_file, output_file, count, error in convert_paths(args.paths, args.output, args.format, args.workers):
+        if error:
+            failed += 1
+            print(f"{input_file}: {error}", file=sys.stderr)
+        else:
+            converted += 1
+            print(f"{input_file} -> {output_file} ({count} cards)")
+
+    print(f"Converted {converted} file(s), {failed} failed.")
+    return 1 if failed else 0
+
 
-def convert_file(input_file, output_file):
-    with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
-        lines = infile.readlines()
-        for line in lines[:-1]:  # Process all lines except the last one
-            parts = line.split(' ', 1)  # Split only on the first space
-            if len(parts) == 2:
-                count, card_name = parts
-                outfile.write(f"{card_name.strip()}, {count}\n")
-        
-        # Process the last line separately without adding a newline at the end
-        last_line = lines[-1]
-        if last_line.strip():  # Check if the last line is not empty
-            parts = last_line.split(' ', 1)
-            if len(parts) == 2:
-                count, card_name = parts
-                outfile.write(f"{card_name.strip()}, {count}")
-
-def select_and_convert_file():
-    input_file = filedialog.askopenfilename(filetypes=[("Text files", "*.txt")])
-    if input_file:
-        output_file = os.path.splitext(input_file)[0] + "_converted.txt"
-        convert_file(input_file, output_file)
-        tk.messagebox.showinfo("Success", f"File converted and saved as {output_file}")
-
-# Set up the tkinter window
-root = tk.Tk()
-root.title("File Converter")
-
-# Create a button to trigger file selection and conversion
-convert_button = tk.Button(root, text="Select File to Convert", command=select_and_convert_file)
-convert_button.pack(pady=20)
-
-# Run the tkinter main loop
-root.mainloop()
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,68 +1,206 @@
-# Import required modules
-import csv
-import sqlite3
-
-# Connecting to the geeks database
-connection = sqlite3.connect("data.db")
-
-# Creating a cursor object to execute
-# SQL queries on a database table
-cursor = connection.cursor()
-
-# SQL query to create the table
-create_table_query = """
-CREATE TABLE IF NOT EXISTS cards (
-    name TEXT PRIMARY KEY,
-    quantity INTEGER NOT NULL
-);
 """
+Create the database and bulk load a collection export into it.
 
-# Creating the table into our
-# database
-cursor.execute(create_table_query)
-"""
-
-# Path to the CSV file
-csv_file_path = "data.csv"
-
-# Initialize an empty list to store the rows
-data_array = []
-
-count = 0
-
-# Open and read the CSV file
-with open(csv_file_path, newline="", encoding="utf-8") as csv_file:
-    reader = csv.reader(csv_file)
-
-    # Iterate over each row in the CSV file
-    for row in reader:
-        # Append the row to the data_array
-        data_array.append(row)
-
-# Print the resulting array
-# print(data_array)
-
-
-for row in data_array[1:]:  # Skip the header row
-    name = row[0].lower()
-    quantity = int(row[1])
-
-    # Insert the data, incrementing the quantity if the name already exists
-    insert_or_update_query = 
-    INSERT INTO cards (name, quantity)
-    VALUES (?, ?)
-    ON CONFLICT(name) DO UPDATE SET quantity = quantity + excluded.quantity;
-    
-    cursor.execute(insert_or_update_query, (name, quantity))
-
-    count += 1
-
-
-# Committing the changes
-connection.commit()
+    python createDB.py                 # create or upgrade data.db only
+    python createDB.py data.csv        # add every card of data.csv
+    python createDB.py big.csv --db other.db
 
+The CSV needs a header row naming its card name and quantity columns (like
+data.csv's "Item Name,Quantity"), otherwise the first two columns are used.
+Quantities are added to the cards already in the inventory.
 """
-# closing the database connection
-connection.close()
-
-print("Database populated with 0 entries.")
+# Import required modules
+import argparse
+import csv
+import itertools
+import sqlite3
+import sys
+import time
+
+from decklist import NAME_COLUMNS, QUANTITY_COLUMNS
+from schema import TABLE_NAME, migrate
+
+
+# Rows handed to executemany at a time
+LOAD_BATCH_SIZE = 50000
+
+# Applied to the loading connection only, for the duration of the load.
+# A power loss mid-load may lose the load itself
+LOAD_PRAGMAS = (
+    "PRAGMA synchronous=OFF",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-262144",   # ~256 MB page cache
+)
+
+
+def read_rows(lines):
+    """
+    Stream (name, quantity) rows out of CSV lines.
+
+    :param lines: An iterable of lines, e.g. an open file.
+    :return: A generator of (lowercase name, quantity) tuples.
+    :raises ValueError: If a row has no name or a quantity that is not an integer, with its line number.
+    """
+    reader = csv.reader(lines)
+    first_row = next(reader, None)
+    if first_row is None:
+        return
+
+    cells = [cell.strip().lower() for cell in first_row]
+    if any(cell in NAME_COLUMNS for cell in cells) and any(cell in QUANTITY_COLUMNS for cell in cells):
+        name_column = next(i for i, cell in enumerate(cells) if cell in NAME_COLUMNS)
+        quantity_column = next(i for i, cell in enumerate(cells) if cell in QUANTITY_COLUMNS)
+        rows = reader
+    else:
+        # No header, the first row is already a card
+        name_column, quantity_column = 0, 1
+        rows = itertools.chain([first_row], reader)
+
+    for row in rows:
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        try:
+            name = row[name_column].strip()
+            quantity = int(row[quantity_column])
+            if not name:
+                raise ValueError("The name column is empty")
+        except (IndexError, ValueError) as e:
+            raise ValueError(f"line {reader.line_num}: {e}") from e
+        yield name.lower(), quantity
+
+
+def load_rows(db_name: str, rows, table_name: str = TABLE_NAME, batch_size: int = LOAD_BATCH_SIZE,
+              exclusive: bool = False) -> int:
+    """
+    Add rows to the inventory in a single transaction.
+
+    Rows are first staged in a temporary table in large executemany batches,
+    then merged with one set-based UPSERT. The per-row triggers (search index
+    and change log) are dropped for the merge and their work is done in bulk
+    instead, which is what makes million-row loads take seconds.
+
+    :param db_name: The SQLite database file name (e.g., 'data.db').
+    :param rows: An iterable of (name, quantity) tuples, see read_rows.
+    :param table_name: The name of the table to load into (e.g., 'cards').
+    :param batch_size: Rows per executemany call.
+    :param exclusive: Nothing else has the database open (e.g. the bot is not
+                      running), so the journal is kept in memory during the load.
+                      A crash mid-load can then leave the file corrupt.
+    :return: The number of rows read.
+    """
+    connection = sqlite3.connect(db_name, timeout=30)
+    journal_mode = None
+    try:
+        migrate(connection, table_name)
+        for pragma in LOAD_PRAGMAS:
+            connection.execute(pragma)
+        if exclusive:
+            journal_mode = connection.execute("PRAGMA journal_mode").fetchone()[0]
+            connection.execute("PRAGMA journal_mode=MEMORY")
+
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute("CREATE TEMP TABLE load_staging (name TEXT NOT NULL, quantity INTEGER NOT NULL)")
+
+        count = 0
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            connection.executemany("INSERT INTO load_staging (name, quantity) VALUES (?, ?)", batch)
+            count += len(batch)
+
+        triggers = connection.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (table_name,)
+        ).fetchall()
+        for trigger_name, _ in triggers:
+            connection.execute(f"DROP TRIGGER {trigger_name}")
+
+        last_id = connection.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table_name}").fetchone()[0]
+
+        # Insert the data, incrementing the quantity if the name already exists
+        connection.execute(f"""
+            INSERT INTO {table_name} (name, quantity)
+            SELECT name, SUM(quantity) FROM load_staging GROUP BY name
+            ON CONFLICT(name) DO UPDATE SET quantity = quantity + excluded.quantity
+        """)
+
+        tables = {name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if f"{table_name}_fts" in tables:
+            # Only new rows need indexing, a quantity change keeps the name
+            connection.execute(f"""
+                INSERT INTO {table_name}_fts (rowid, name) SELECT id, name FROM {table_name} WHERE id > ?
+            """, (last_id,))
+        if f"{table_name}_changes" in tables:
+            # The whole load is one new version of the inventory
+            connection.execute(f"""
+                INSERT INTO {table_name}_changes (name, quantity, version)
+                SELECT c.name, c.quantity, (SELECT COALESCE(MAX(version), 0) + 1 FROM {table_name}_changes)
+                FROM {table_name} AS c WHERE c.name IN (SELECT name FROM load_staging)
+                ON CONFLICT(name) DO UPDATE SET quantity = excluded.quantity, version = excluded.version
+            """)
+
+        for _, trigger_sql in triggers:
+            connection.execute(trigger_sql)
+        connection.execute("DROP TABLE load_staging")
+
+        # Committing the changes
+        connection.commit()
+        return count
+
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        if journal_mode is not None:
+            # Back to what the bot expects, usually WAL
+            connection.execute(f"PRAGMA journal_mode={journal_mode}")
+        # closing the database connection
+        connection.close()
+
+
+def load_csv(db_name: str, lines, table_name: str = TABLE_NAME, exclusive: bool = False) -> tuple:
+    """
+    Bulk load a CSV collection export.
+
+    :param db_name: The SQLite database file name (e.g., 'data.db').
+    :param lines: The CSV lines, e.g. an open file or a list of strings.
+    :param table_name: The name of the table to load into (e.g., 'cards').
+    :param exclusive: Nothing else has the database open, see load_rows.
+    :return: The number of rows loaded and the seconds it took.
+    """
+    started = time.perf_counter()
+    count = load_rows(db_name, read_rows(lines), table_name, exclusive=exclusive)
+    return count, time.perf_counter() - started
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Create the database and bulk load a CSV collection export into it.")
+    parser.add_argument("csv_file", nargs="?", help="the CSV file to load, e.g. data.csv")
+    parser.add_argument("--db", default="data.db", help="the database file (default: data.db)")
+    parser.add_argument("--shared", action="store_true",
+                        help="the bot may be running, keep the journal on disk (slower)")
+    args = parser.parse_args(argv)
+
+    if args.csv_file is None:
+        # Create the tables, or bring an older database up to date
+        connection = sqlite3.connect(args.db)
+        migrate(connection)
+        connection.close()
+        print(f"Database {args.db} is up to date.")
+        return 0
+
+    # Stream the CSV file, only one batch of rows is held in memory
+    with open(args.csv_file, newline="", encoding="utf-8-sig") as csv_file:
+        try:
+            count, seconds = load_csv(args.db, csv_file, exclusive=not args.shared)
+        except ValueError as e:
+            print(f"{args.csv_file}: {e}", file=sys.stderr)
+            return 1
+
+    print(f"Database populated with {count} entries in {seconds:.2f} s ({count / seconds if seconds else count:.0f} rows/s).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from schema import has_search_index, migrate
+
+
+# Number of connections kept open per database file, opened only as concurrent use needs them
+POOL_SIZE = 4
+
+# Page cache of every connection in KiB. With up to tenants.MAX_OPEN_SHARDS
+# collections open, each with up to POOL_SIZE connections, keep it modest:
+# a collection of a few thousand cards fits in well under 1 MB
+CACHE_SIZE_KIB = int(os.environ.get("SQLITE_CACHE_KIB", "4096"))
+
+# Prepared statements cached per connection (sqlite3 default is 128)
+CACHED_STATEMENTS = 256
+
+# Seconds a connection waits on a locked database before giving up
+BUSY_TIMEOUT = 5.0
+
+# Applied to every new connection
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",      # readers no longer block the writer
+    "PRAGMA synchronous=NORMAL",    # safe with WAL, one fsync per checkpoint
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA cache_size=-{CACHE_SIZE_KIB}",
+    "PRAGMA mmap_size=134217728",   # 128 MB memory mapped I/O
+)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+_write_listeners = []
+
+
+class ConnectionPool:
+    """
+    A small pool of long-lived connections to a single SQLite database file.
+
+    Connections are opened lazily up to `size` and handed out one at a time,
+    so they can be shared between threads without sharing a cursor.
+    """
+
+    def __init__(self, db_name: str, size: int = POOL_SIZE):
+        self.db_name = db_name
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._migrated = False
+        self.search_index = False
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS,
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        # Bring older database files up to date before anyone uses them,
+        # a current file only costs one PRAGMA user_version read
+        if not self._migrated:
+            migrate(conn)
+            self.search_index = has_search_index(conn)
+            self._migrated = True
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        # Reuse an idle connection if there is one
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError(f"Connection pool for '{self.db_name}' is closed.")
+            if len(self._opened) < self.size:
+                conn = self._open()
+                self._opened.append(conn)
+                return conn
+
+        # Every connection is busy, wait for one to come back
+        while True:
+            try:
+                return self._idle.get(timeout=BUSY_TIMEOUT)
+            except queue.Empty:
+                if self._closed:
+                    raise sqlite3.ProgrammingError(f"Connection pool for '{self.db_name}' is closed.")
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        # Never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        # Idle connections are closed now, the ones in use when they are released
+        with self._lock:
+            self._closed = True
+            self._opened = []
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+
+def get_pool(db_name: str) -> ConnectionPool:
+    """
+    Return the connection pool for a database file, creating it on first use.
+
+    :param db_name: The SQLite database file name (e.g., 'data.db').
+    :return: The shared ConnectionPool for that file.
+    """
+    pool = _pools.get(db_name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_name)
+            if pool is None:
+                pool = ConnectionPool(db_name)
+                _pools[db_name] = pool
+    return pool
+
+
+@contextmanager
+def connection(db_name: str):
+    """
+    Borrow a pooled connection to the given database for the duration of a with block.
+
+    :param db_name: The SQLite database file name (e.g., 'data.db').
+    """
+    with get_pool(db_name).connection() as conn:
+        yield conn
+
+
+def close_all() -> None:
+    """
+    Close every pooled connection. Called once when the bot shuts down.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def close_pool(db_name: str) -> None:
+    """
+    Close the pooled connections of a single database, e.g. before deleting its file.
+
+    :param db_name: The SQLite database file name (e.g., 'data.db').
+    """
+    with _pools_lock:
+        pool = _pools.pop(db_name, None)
+    if pool is not None:
+        pool.close()
+
+
+def add_write_listener(listener) -> None:
+    """
+    Register a callable run after every committed change to an inventory table.
+
+    It is called as listener(db_name, table_name, changes), where changes maps
+    each touched card name to its new quantity (0 or less means deleted), or is
+    None when the whole table changed and any derived state should be dropped.
+
+    :param listener: The callable to register.
+    """
+    _write_listeners.append(listener)
+
+
+def notify_write(db_name: str, table_name: str, changes: dict) -> None:
+    """
+    Tell every registered listener about a committed change.
+
+    :param db_name: The SQLite database file name (e.g., 'data.db').
+    :param table_name: The name of the changed table (e.g., 'cards').
+    :param changes: A dict mapping card names to their new quantity, or None.
+    """
+    for listener in _write_listeners:
+        listener(db_name, table_name, changes)
+
@@ -0,0 +1,208 @@
+import csv
+import io
+import os
+import re
+import zipfile
+
+
+# Line formats a decklist can be in:
+#   csv    'Sakura-Tribe Elder, 2'   (what the bot exports and always accepted)
+#   mtgo   '2 Sakura-Tribe Elder'    (MTGO / Arena / most deck builders, '2x' works too)
+#   table  a CSV file with a header row naming its columns, like data.csv
+DECKLIST_FORMATS = ("csv", "mtgo", "table")
+
+# Header cells recognised as the card name and quantity columns of a table
+NAME_COLUMNS = ("name", "card name", "item name", "card")
+QUANTITY_COLUMNS = ("quantity", "count", "qty", "amount")
+
+# Section headers of exported decklists, they carry no card
+SECTION_HEADERS = ("deck", "sideboard", "commander", "companion", "maybeboard", "about")
+
+# Files of a zip archive read as decklists, one deck each
+DECKLIST_EXTENSIONS = (".txt", ".csv")
+
+# Largest total uncompressed size accepted from an archive
+MAX_ARCHIVE_BYTES = 20 * 1024 * 1024
+
+_mtgo_line = re.compile(r"^\s*(\d+)x?\s+(.+?)\s*$", re.IGNORECASE)
+_csv_line = re.compile(r",\s*\d+\s*$")
+# Arena appends the set code and collector number: '1 Sol Ring (CMR) 472'
+_set_suffix = re.compile(r"\s+\([A-Za-z0-9]{2,6}\)(\s+\S+)?$")
+
+
+def parse_line(line: str) -> tuple:
+    """
+    Parse a single "name, quantity" decklist line.
+
+    :param line: A line such as 'Sakura-Tribe Elder, 2'.
+    :return: A (name, quantity) tuple.
+    :raises ValueError: If the line has no quantity or the name is empty.
+    """
+    if "," not in line:
+        raise ValueError(f"Expected a card name followed by a comma and a quantity, got '{line.strip()}'")
+
+    name, quantity = line.rsplit(",", 1)
+    name = name.strip()
+
+    if not name:
+        raise ValueError("The name part of the line is empty")
+
+    return name, int(quantity.strip())
+
+
+def parse_mtgo_line(line: str) -> tuple:
+    """
+    Parse a single "quantity name" decklist line.
+
+    :param line: A line such as '2 Sakura-Tribe Elder' or '1 Sol Ring (CMR) 472'.
+    :return: A (name, quantity) tuple.
+    :raises ValueError: If the line does not start with a quantity.
+    """
+    match = _mtgo_line.match(line)
+    if match is None:
+        raise ValueError(f"Expected a quantity followed by a card name, got '{line.strip()}'")
+
+    return _set_suffix.sub("", match.group(2)), int(match.group(1))
+
+
+class DecklistParser:
+    """
+    Parses decklist lines one at a time, in any of DECKLIST_FORMATS.
+
+    Unless given, the format is detected from the first line that is not
+    blank, so a file can be parsed while it is still being read.
+    """
+
+    def __init__(self, decklist_format: str = None):
+        if decklist_format is not None and decklist_format not in DECKLIST_FORMATS:
+            raise ValueError(f"Unknown decklist format '{decklist_format}'")
+        self.format = decklist_format
+        self._columns = None  # (name, quantity) column indexes of a table
+
+    def parse(self, line: str):
+        """
+        Parse one line.
+
+        :param line: The line, with or without its line ending.
+        :return: A (name, quantity) tuple, or None for lines carrying no card
+                 (blank lines, the header row, section headers).
+        :raises ValueError: If the line cannot be parsed.
+        """
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            return None
+
+        if line.strip().rstrip(":").lower() in SECTION_HEADERS:
+            return None
+
+        if self.format is None:
+            self.format = self._detect(line)
+        if self.format == "table" and self._columns is None:
+            self._columns = self._read_header(line)
+            return None
+
+        if self.format == "mtgo":
+            return parse_mtgo_line(line)
+        if self.format == "table":
+            return self._parse_row(line)
+        return parse_line(line)
+
+    def _detect(self, line: str) -> str:
+        cells = [cell.strip().lower() for cell in next(csv.reader([line]))]
+        if any(cell in NAME_COLUMNS for cell in cells) and any(cell in QUANTITY_COLUMNS for cell in cells):
+            return "table"
+        if _mtgo_line.match(line) and not _csv_line.search(line):
+            return "mtgo"
+        return "csv"
+
+    def _read_header(self, line: str) -> tuple:
+        cells = [cell.strip().lower() for cell in next(csv.reader([line]))]
+        name = next(i for i, cell in enumerate(cells) if cell in NAME_COLUMNS)
+        quantity = next(i for i, cell in enumerate(cells) if cell in QUANTITY_COLUMNS)
+        return name, quantity
+
+    def _parse_row(self, line: str) -> tuple:
+        cells = next(csv.reader([line]))
+        name_column, quantity_column = self._columns
+        if len(cells) <= max(name_column, quantity_column):
+            raise ValueError(f"Expected at least {max(name_column, quantity_column) + 1} columns, got {len(cells)}")
+
+        name = cells[name_column].strip()
+        if not name:
+            raise ValueError("The name column is empty")
+
+        return name, int(cells[quantity_column].strip())
+
+
+def iter_decklist(lines, decklist_format: str = None):
+    """
+    Parse decklist lines lazily, detecting their format.
+
+    :param lines: An iterable of lines, e.g. an open file.
+    :param decklist_format: One of DECKLIST_FORMATS, detected when None.
+    :return: A generator of (name, quantity) tuples in file order.
+    :raises ValueError: If a line cannot be parsed, with its line number.
+    """
+    parser = DecklistParser(decklist_format)
+    for line_number, line in enumerate(lines, start=1):
+        try:
+            card = parser.parse(line)
+        except ValueError as e:
+            raise ValueError(f"line {line_number}: {e}") from e
+        if card is not None:
+            yield card
+
+
+def parse_decklist(text: str) -> list:
+    """
+    Parse the content of an uploaded decklist, skipping blank lines.
+
+    :param text: The whole file content, in any of DECKLIST_FORMATS.
+    :return: A list of (name, quantity) tuples in file order.
+    """
+    return list(iter_decklist(text.replace("\r", "").split("\n")))  # Remove carriage return characters because Windows
+
+
+def read_decklist_archive(data: bytes, max_bytes: int = MAX_ARCHIVE_BYTES) -> list:
+    """
+    Parse every decklist of a zip archive.
+
+    :param data: The zip file content.
+    :param max_bytes: The largest total uncompressed size accepted.
+    :return: A list of (deck name, cards) tuples in archive order, the deck
+             name being the file name without its extension.
+    :raises ValueError: If the archive is invalid or too large, or a decklist
+                        cannot be parsed (with its file name and line number).
+    """
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"not a zip archive ({e})") from e
+
+    with archive:
+        members = [
+            member for member in archive.infolist()
+            if not member.is_dir() and member.filename.lower().endswith(DECKLIST_EXTENSIONS)
+            # Skip the metadata macOS adds to archives
+            and not member.filename.startswith("__MACOSX/")
+            and not os.path.basename(member.filename).startswith(".")
+        ]
+        if sum(member.file_size for member in members) > max_bytes:
+            raise ValueError(f"the archive is larger than {max_bytes // (1024 * 1024)} MB uncompressed")
+
+        decks = []
+        for member in members:
+            name = os.path.splitext(os.path.basename(member.filename))[0]
+            text = archive.read(member).decode("utf-8-sig", errors="replace")
+            try:
+                decks.append((name, parse_decklist(text)))
+            except ValueError as e:
+                raise ValueError(f"{member.filename}: {e}") from e
+    return decks
+
+
+def format_line(name: str, quantity: int) -> str:
+    """
+    Format a card as a "name, quantity" line, the format the bot reads back.
+    """
+    return f"{name}, {quantity}"
@@ -0,0 +1,216 @@
+import difflib
+import heapq
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+from db import add_write_listener, connection
+
+
+# Scores are difflib similarity ratios between squashed names, from 0 to 1.
+# At or above this the closest card is used without asking
+AUTO_RESOLVE_SCORE = 0.9
+# At or above this the closest card is offered as a suggestion
+SUGGEST_SCORE = 0.6
+
+# Candidates are gathered from the rarest trigrams of the query first,
+# which keeps lookups fast even when common trigrams have huge posting lists
+MAX_CANDIDATES = 256
+
+# Best candidates by shared trigrams that get the (slower) exact similarity score
+RESCORE_CANDIDATES = 8
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+_non_alnum = re.compile(r"[\W_]+")
+
+
+def squash(name: str) -> str:
+    """
+    Reduce a card name to lowercase letters and digits only.
+
+    'Sakura Tribe Elder' and 'Sakura-Tribe Elder' both become 'sakuratribeelder'.
+    """
+    return _non_alnum.sub("", name.lower())
+
+
+def trigrams(key: str) -> frozenset:
+    # Padding lets short names and word starts produce trigrams too
+    padded = f"  {key} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class FuzzyIndex:
+    """
+    A trigram index over inventory card names, updated incrementally.
+    """
+
+    def __init__(self, names=()):
+        self._lock = threading.Lock()
+        self._exact = {}                 # squashed key -> name
+        self._grams = {}                 # name -> its trigrams
+        self._postings = defaultdict(set)  # trigram -> names containing it
+        for name in names:
+            self.add(name)
+
+    def __len__(self) -> int:
+        return len(self._grams)
+
+    def add(self, name: str) -> None:
+        with self._lock:
+            if name in self._grams:
+                return
+            key = squash(name)
+            grams = trigrams(key)
+            self._exact.setdefault(key, name)
+            self._grams[name] = grams
+            for gram in grams:
+                self._postings[gram].add(name)
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            grams = self._grams.pop(name, None)
+            if grams is None:
+                return
+            key = squash(name)
+            if self._exact.get(key) == name:
+                del self._exact[key]
+            for gram in grams:
+                names = self._postings[gram]
+                names.discard(name)
+                if not names:
+                    del self._postings[gram]
+
+    def closest(self, name: str, limit: int = 1, min_score: float = 0.0) -> list:
+        """
+        Find the indexed names closest to a possibly misspelled one.
+
+        :param name: The name to look up.
+        :param limit: The maximum number of matches to return.
+        :param min_score: Skip candidates that cannot reach this score.
+        :return: A list of (name, score) tuples, best first.
+        """
+        key = squash(name)
+        grams = trigrams(key)
+
+        with self._lock:
+            exact = self._exact.get(key)
+            if exact is not None and limit == 1:
+                return [(exact, 1.0)]
+
+            # Each character that differs breaks at most 3 of the query's trigrams, so a
+            # match scoring min_score still shares about `required` of them and has to
+            # appear in one of the rarest `len(postings) - required + 1` posting lists
+            postings = sorted((self._postings[gram] for gram in grams if gram in self._postings), key=len)
+            required = max(math.ceil(len(grams) * (1 - 3 * (1 - min_score))), 1)
+            probe = max(len(postings) - required + 1, 1)
+
+            # Count shared trigrams, starting from the rarest ones. Once there are
+            # enough candidates the remaining (common) trigrams only add to counts
+            shared = Counter()
+            pool = None
+            for i, names in enumerate(postings):
+                if pool is not None:
+                    shared.update(names & pool)
+                else:
+                    shared.update(names)
+                    if len(shared) >= MAX_CANDIDATES or i + 1 >= probe:
+                        pool = set(shared)
+
+            shortlist = [candidate for candidate, count in shared.most_common(max(limit, RESCORE_CANDIDATES)) if count >= required]
+
+        # Then score the shortlist by edit similarity, which handles single typos better
+        matcher = difflib.SequenceMatcher(autojunk=False)
+        matcher.set_seq2(key)
+        scored = []
+        for candidate in shortlist:
+            matcher.set_seq1(squash(candidate))
+            # The quick upper bounds rule most candidates out before the full ratio
+            if matcher.real_quick_ratio() < min_score or matcher.quick_ratio() < min_score:
+                continue
+            scored.append((matcher.ratio(), candidate))
+        best = heapq.nlargest(limit, scored)
+
+        return [(candidate, score) for score, candidate in best]
+
+    def exact(self, name: str):
+        """
+        Return the indexed name that squashes to the same key, or None.
+
+        'Sakura Tribe Elder' finds 'Sakura-Tribe Elder', but 'Sol Rings' does
+        not find 'Sol Ring': used where a wrong guess would change the inventory.
+        """
+        return self._exact.get(squash(name))
+
+    def resolve(self, name: str):
+        """
+        Return the indexed name a misspelled name should be treated as, or None.
+
+        Only an unambiguous match scoring at least AUTO_RESOLVE_SCORE is returned.
+        """
+        exact = self.exact(name)
+        if exact is not None:
+            return exact
+
+        matches = self.closest(name, limit=2, min_score=AUTO_RESOLVE_SCORE)
+        if not matches or matches[0][1] < AUTO_RESOLVE_SCORE:
+            return None
+        if len(matches) > 1 and matches[1][1] == matches[0][1]:
+            return None
+        return matches[0][0]
+
+    def suggest(self, name: str):
+        """
+        Return the closest indexed name worth suggesting, or None.
+        """
+        matches = self.closest(name, min_score=SUGGEST_SCORE)
+        if matches and matches[0][1] >= SUGGEST_SCORE:
+            return matches[0][0]
+        return None
+
+
+def get_index(db_name: str, table_name: str) -> FuzzyIndex:
+    """
+    Return the fuzzy index over a table's card names, building it on first use.
+
+    :param db_name: The SQLite database file name (e.g., 'data.db').
+    :param table_name: The name of the table to index (e.g., 'cards').
+    """
+    index = _indexes.get((db_name, table_name))
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get((db_name, table_name))
+            if index is None:
+                with connection(db_name) as conn:
+                    names = [row[0] for row in conn.execute(f"SELECT name FROM {table_name}")]
+                index = FuzzyIndex(names)
+                _indexes[(db_name, table_name)] = index
+    return index
+
+
+def drop_index(db_name: str, table_name: str) -> None:
+    """
+    Forget the fuzzy index of a table, it is rebuilt on next use.
+    """
+    _indexes.pop((db_name, table_name), None)
+
+
+def _on_write(db_name: str, table_name: str, changes: dict) -> None:
+    if changes is None:
+        # The whole table changed, rebuild on next use
+        drop_index(db_name, table_name)
+        return
+    # Only indexes that were already built need to follow the change
+    index = _indexes.get((db_name, table_name))
+    if index is None:
+        return
+    for name, quantity in changes.items():
+        if quantity > 0:
+            index.add(name)
+        else:
+            index.remove(name)
+
+
+add_write_listener(_on_write)
@@ -0,0 +1,146 @@
+import codecs
+
+import aiohttp
+
+from decklist import DecklistParser
+from metrics import increment
+
+
+# Bytes read from the download per iteration
+CHUNK_SIZE = 64 * 1024
+
+# Parsed cards handed to the database layer at a time
+BATCH_SIZE = 500
+
+# Largest upload we are willing to download (the Bot API serves files up to 20 MB)
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+
+# Give up on slow or stalled downloads instead of holding a handler forever
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=120, connect=10, sock_read=30)
+
+# Connections to api.telegram.org kept alive between downloads
+MAX_CONNECTIONS = 10
+KEEPALIVE_SECONDS = 60
+DNS_CACHE_SECONDS = 300
+
+
+class DownloadTooLarge(ValueError):
+    pass
+
+
+def create_session() -> aiohttp.ClientSession:
+    """
+    Create the HTTP session shared by every file download.
+
+    Must be called from inside the running event loop (e.g., Application.post_init).
+
+    :return: A ClientSession with keep-alive, DNS caching and download timeouts.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONNECTIONS,
+        keepalive_timeout=KEEPALIVE_SECONDS,
+        ttl_dns_cache=DNS_CACHE_SECONDS,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=DOWNLOAD_TIMEOUT)
+
+
+def check_download_size(size) -> None:
+    """
+    Reject a download whose announced size is over the limit.
+
+    :param size: The size in bytes, or None when unknown.
+    :raises DownloadTooLarge: If the size exceeds MAX_DOWNLOAD_BYTES.
+    """
+    if size is not None and size > MAX_DOWNLOAD_BYTES:
+        raise DownloadTooLarge(f"the file is larger than {MAX_DOWNLOAD_BYTES // (1024 * 1024)} MB")
+
+
+async def iter_lines(response, chunk_size: int = CHUNK_SIZE, command: str = "upload", on_chunk=None):
+    """
+    Yield the lines of an aiohttp response body as they arrive.
+
+    Only the current chunk and the unfinished last line are held in memory.
+
+    :param response: An aiohttp ClientResponse whose body has not been read yet.
+    :param chunk_size: Bytes to read per iteration.
+    :param command: The command the downloaded bytes are counted under.
+    :param on_chunk: Called with the size of every chunk received, e.g. for progress reports.
+    :raises DownloadTooLarge: If the body grows past MAX_DOWNLOAD_BYTES.
+    """
+    check_download_size(response.content_length)
+
+    # utf-8-sig drops the BOM Windows editors like to add
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    received = 0
+
+    async for chunk in response.content.iter_chunked(chunk_size):
+        # The announced length can be missing or wrong, count what actually arrives
+        received += len(chunk)
+        increment("bot_download_bytes_total", command, len(chunk))
+        check_download_size(received)
+        if on_chunk is not None:
+            on_chunk(len(chunk))
+
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")  # Remove carriage return characters because Windows
+
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def read_body(response, chunk_size: int = CHUNK_SIZE, command: str = "upload", on_chunk=None) -> bytes:
+    """
+    Read a whole binary download, e.g. a zip archive, enforcing MAX_DOWNLOAD_BYTES.
+
+    :param response: An aiohttp ClientResponse whose body has not been read yet.
+    :param chunk_size: Bytes to read per iteration.
+    :param command: The command the downloaded bytes are counted under.
+    :param on_chunk: Called with the size of every chunk received, e.g. for progress reports.
+    :raises DownloadTooLarge: If the body grows past MAX_DOWNLOAD_BYTES.
+    """
+    check_download_size(response.content_length)
+
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(chunk_size):
+        body += chunk
+        increment("bot_download_bytes_total", command, len(chunk))
+        check_download_size(len(body))
+        if on_chunk is not None:
+            on_chunk(len(chunk))
+    return bytes(body)
+
+
+async def iter_batches(response, batch_size: int = BATCH_SIZE, command: str = "upload", on_chunk=None):
+    """
+    Parse a decklist download incrementally and yield it in fixed-size batches.
+    Any of decklist.DECKLIST_FORMATS is accepted, detected from the first line.
+
+    :param response: An aiohttp ClientResponse whose body has not been read yet.
+    :param batch_size: Number of (name, quantity) tuples per batch.
+    :param command: The command the downloaded bytes are counted under.
+    :param on_chunk: Called with the size of every chunk received, e.g. for progress reports.
+    :raises ValueError: If a line cannot be parsed, with its line number.
+    """
+    parser = DecklistParser()
+    batch = []
+    line_number = 0
+
+    async for line in iter_lines(response, command=command, on_chunk=on_chunk):
+        line_number += 1
+        try:
+            card = parser.parse(line)
+        except ValueError as e:
+            raise ValueError(f"line {line_number}: {e}") from e
+        if card is not None:
+            batch.append(card)
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+
+from telegram.error import BadRequest
+
+from metrics import increment, observe
+
+
+# Jobs processed at the same time across every user
+MAX_RUNNING_JOBS = int(os.environ.get("MAX_RUNNING_JOBS", "2"))
+
+# Jobs a single user may have queued or running; each user's jobs run one
+# at a time and in the order they were sent, so an /add then /remove of the
+# same cards behaves as expected
+MAX_JOBS_PER_USER = int(os.environ.get("MAX_JOBS_PER_USER", "3"))
+
+# Least number of seconds between two edits of a status message
+# (Telegram rate limits message edits)
+PROGRESS_INTERVAL = 3.0
+
+
+class TooManyJobs(Exception):
+    pass
+
+
+class Progress:
+    """
+    Reports the progress of a job by editing a single status message.
+    """
+
+    def __init__(self, message, total_bytes: int = None):
+        """
+        :param message: The status message to edit (a telegram Message).
+        :param total_bytes: The size of the file being processed, when known.
+        """
+        self.message = message
+        self.total_bytes = total_bytes
+        self.bytes = 0
+        self.lines = 0
+        self.started = time.monotonic()
+        self._last_edit = 0.0
+        self._text = message.text
+
+    def add_bytes(self, count: int) -> None:
+        self.bytes += count
+
+    async def edit(self, text: str) -> None:
+        """
+        Replace the status text, skipping edits that would not change it.
+        """
+        if text == self._text:
+            return
+        self._text = text
+        self._last_edit = time.monotonic()
+        try:
+            await self.message.edit_text(text)
+        except BadRequest as e:
+            # e.g. the message was deleted, progress is not worth failing the job for
+            logging.warning(f"Could not update a status message: {e}")
+
+    async def update(self, lines: int) -> None:
+        """
+        Count processed lines and refresh the status message, at most every PROGRESS_INTERVAL seconds.
+
+        :param lines: The number of lines processed since the last call.
+        """
+        self.lines += lines
+        if time.monotonic() - self._last_edit < PROGRESS_INTERVAL:
+            return
+        text = f"Processing: {self.lines} lines"
+        if self.total_bytes:
+            text += f" ({min(self.bytes / self.total_bytes, 1):.0%})"
+        await self.edit(text)
+
+    async def finish(self, text: str = None) -> None:
+        """
+        Show the final status, by default the number of lines and the time taken.
+        """
+        await self.edit(text or f"Done: {self.lines} lines in {time.monotonic() - self.started:.1f} s.")
+
+
+class JobQueue:
+    """
+    Runs long operations in the background with bounded concurrency.
+
+    Must be created and used from inside the running event loop.
+    """
+
+    def __init__(self, max_running: int = MAX_RUNNING_JOBS, max_per_user: int = MAX_JOBS_PER_USER):
+        self.max_per_user = max_per_user
+        self._running = asyncio.Semaphore(max_running)
+        self._user_locks = {}
+        self._pending = Counter()  # user id -> jobs queued or running
+        self._tasks = set()
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def submit(self, user_id: int, name: str, job) -> asyncio.Task:
+        """
+        Queue a job and return without waiting for it.
+
+        :param user_id: The user the job belongs to.
+        :param name: The name the job is recorded under in the metrics (e.g., '/add').
+        :param job: A coroutine function taking no arguments.
+        :raises TooManyJobs: If the user already has `max_per_user` jobs queued or running.
+        """
+        if self._pending[user_id] >= self.max_per_user:
+            raise TooManyJobs(f"you already have {self._pending[user_id]} file(s) being processed, please wait for them to finish")
+        self._pending[user_id] += 1
+
+        task = asyncio.create_task(self._run(user_id, name, job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, user_id: int, name: str, job) -> None:
+        lock = self._user_locks.setdefault(user_id, asyncio.Lock())
+        try:
+            async with lock, self._running:
+                started = time.perf_counter()
+                try:
+                    await job()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    increment("bot_job_errors_total", name)
+                    logging.exception(f"{name} job of user {user_id} failed")
+                finally:
+                    observe("bot_job_seconds", name, time.perf_counter() - started)
+        finally:
+            self._pending[user_id] -= 1
+            if not self._pending[user_id]:
+                del self._pending[user_id]
+                self._user_locks.pop(user_id, None)
+
+    async def shutdown(self) -> None:
+        """
+        Cancel every queued or running job and wait for them to stop.
+        """
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,273 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+
+from aiohttp import web
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Seconds between two writes of the Prometheus dump file
+DUMP_INTERVAL = 15
+
+# Optional exports, both off unless set: a file rewritten every DUMP_INTERVAL
+# seconds and a local port serving GET /metrics
+METRICS_FILE = os.environ.get("METRICS_FILE")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+
+_lock = threading.Lock()
+_histograms = {}   # (metric, label value) -> Histogram
+_counters = {}     # (metric, label value) -> number
+
+# Help text and label name of every metric, used for the Prometheus dump
+METRICS = {
+    "bot_command_seconds": ("Time spent handling a command", "command"),
+    "bot_command_errors_total": ("Commands that raised an exception", "command"),
+    "bot_query_seconds": ("Time spent in a sql.py function", "query"),
+    "bot_query_errors_total": ("sql.py calls that raised an exception", "query"),
+    "bot_job_seconds": ("Time spent running a background upload job", "command"),
+    "bot_job_errors_total": ("Background jobs that failed", "command"),
+    "bot_download_bytes_total": ("Bytes downloaded from uploaded files", "command"),
+}
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets, enough to estimate percentiles cheaply.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile by interpolating inside the bucket it falls in.
+
+        :param q: The quantile, from 0 to 1 (e.g., 0.99).
+        :return: The estimated value, 0 without observations.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for index, count in enumerate(self.counts):
+            upper = self.buckets[index] if index < len(self.buckets) else lower
+            if count and seen + count >= rank:
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return lower
+
+
+def observe(metric: str, label: str, seconds: float) -> None:
+    """
+    Record a duration in the histogram of a metric.
+
+    :param metric: The metric name (e.g., 'bot_command_seconds').
+    :param label: The label value (e.g., the command name).
+    :param seconds: The duration to record.
+    """
+    with _lock:
+        histogram = _histograms.get((metric, label))
+        if histogram is None:
+            histogram = _histograms[(metric, label)] = Histogram()
+        histogram.observe(seconds)
+
+
+def increment(metric: str, label: str, amount: int = 1) -> None:
+    """
+    Add to a counter.
+
+    :param metric: The metric name (e.g., 'bot_download_bytes_total').
+    :param label: The label value (e.g., the command name).
+    :param amount: How much to add.
+    """
+    with _lock:
+        _counters[(metric, label)] = _counters.get((metric, label), 0) + amount
+
+
+def timed_command(command: str, handler):
+    """
+    Wrap a bot handler so its latency, count and errors are recorded.
+
+    :param command: The name the handler is recorded under (e.g., 'search').
+    :param handler: The async handler to wrap.
+    """
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            increment("bot_command_errors_total", command)
+            raise
+        finally:
+            observe("bot_command_seconds", command, time.perf_counter() - started)
+    return wrapper
+
+
+def timed_query(func):
+    """
+    Decorate a sql.py function so the time spent in it is recorded under its name.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            increment("bot_query_errors_total", func.__name__)
+            raise
+        finally:
+            observe("bot_query_seconds", func.__name__, time.perf_counter() - started)
+    return wrapper
+
+
+def snapshot() -> tuple:
+    """
+    Copy the current metrics.
+
+    :return: A dict of (metric, label) -> (count, sum, p50, p99, bucket counts)
+             for histograms and a dict of (metric, label) -> value for counters.
+    """
+    with _lock:
+        histograms = {
+            key: (h.count, h.sum, h.quantile(0.5), h.quantile(0.99), list(h.counts))
+            for key, h in _histograms.items()
+        }
+        counters = dict(_counters)
+    return histograms, counters
+
+
+def reset() -> None:
+    """
+    Forget every recorded metric.
+    """
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def format_stats() -> list:
+    """
+    Summarise the metrics for the /stats command, one line per command or query.
+    """
+    histograms, counters = snapshot()
+    lines = []
+
+    for metric, errors_metric, title in (
+        ("bot_command_seconds", "bot_command_errors_total", "Commands"),
+        ("bot_job_seconds", "bot_job_errors_total", "Upload jobs"),
+        ("bot_query_seconds", "bot_query_errors_total", "Queries"),
+    ):
+        rows = sorted(((label, value) for (name, label), value in histograms.items() if name == metric),
+                      key=lambda row: row[1][1], reverse=True)
+        if not rows:
+            continue
+        lines.append(f"{title} (count, errors, p50, p99, total):")
+        for label, (count, total, p50, p99, _) in rows:
+            errors = counters.get((errors_metric, label), 0)
+            lines.append(f"{label}: {count}, {errors} ({errors / count:.1%}), "
+                         f"{p50 * 1000:.1f} ms, {p99 * 1000:.1f} ms, {total:.2f} s")
+
+    downloads = [(label, value) for (name, label), value in counters.items() if name == "bot_download_bytes_total"]
+    if downloads:
+        lines.append("Downloaded:")
+        for label, value in sorted(downloads):
+            lines.append(f"{label}: {value / 1024:.1f} KB")
+
+    return lines or ["No commands recorded yet."]
+
+
+def render_prometheus() -> str:
+    """
+    Render every metric in the Prometheus text exposition format.
+    """
+    histograms, counters = snapshot()
+    out = []
+
+    for metric, (help_text, label_name) in METRICS.items():
+        if metric.endswith("_seconds"):
+            series = sorted((label, value) for (name, label), value in histograms.items() if name == metric)
+            if not series:
+                continue
+            out.append(f"# HELP {metric} {help_text}")
+            out.append(f"# TYPE {metric} histogram")
+            for label, (count, total, _, _, buckets) in series:
+                label = _escape(label)
+                cumulative = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                    cumulative += bucket_count
+                    out.append(f'{metric}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+                out.append(f'{metric}_sum{{{label_name}="{label}"}} {total}')
+                out.append(f'{metric}_count{{{label_name}="{label}"}} {count}')
+        else:
+            series = sorted((label, value) for (name, label), value in counters.items() if name == metric)
+            if not series:
+                continue
+            out.append(f"# HELP {metric} {help_text}")
+            out.append(f"# TYPE {metric} counter")
+            for label, value in series:
+                out.append(f'{metric}{{{label_name}="{_escape(label)}"}} {value}')
+
+    return "\n".join(out) + "\n"
+
+
+def _escape(label: str) -> str:
+    return label.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_prometheus(path: str) -> None:
+    """
+    Write the Prometheus dump to a file, replacing it atomically so scrapers never read half of it.
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as file:
+        file.write(render_prometheus())
+    os.replace(temp_path, path)
+
+
+async def dump_periodically(path: str, interval: float = DUMP_INTERVAL) -> None:
+    """
+    Rewrite the Prometheus dump file every `interval` seconds until cancelled.
+    """
+    while True:
+        write_prometheus(path)
+        await asyncio.sleep(interval)
+
+
+async def handle_metrics(request) -> web.Response:
+    """
+    aiohttp handler answering with the Prometheus dump.
+    """
+    return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> web.AppRunner:
+    """
+    Serve the Prometheus dump on GET /metrics.
+
+    :return: The runner, call its cleanup() to stop serving.
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,70 @@
+import io
+
+from telegram import Update
+from telegram.constants import MessageLimit
+
+
+# Longest text Telegram accepts in a single message
+MAX_MESSAGE_LENGTH = MessageLimit.MAX_TEXT_LENGTH
+
+# Above this many packed messages the rows are sent as one document instead
+MAX_MESSAGES = 5
+
+
+def pack_rows(rows, limit: int = MAX_MESSAGE_LENGTH) -> list:
+    """
+    Pack result rows into as few messages as possible, one row per line.
+
+    :param rows: The rows to send, e.g. the list returned by search_card.
+    :param limit: The maximum length of a single message.
+    :return: A list of message texts, each at most `limit` characters long.
+    """
+    messages = []
+    current = ""
+
+    for row in rows:
+        row = str(row)
+
+        # A single row longer than a message is split on its own
+        while len(row) > limit:
+            if current:
+                messages.append(current)
+                current = ""
+            messages.append(row[:limit])
+            row = row[limit:]
+
+        if not current:
+            current = row
+        elif len(current) + 1 + len(row) <= limit:
+            current += "\n" + row
+        else:
+            messages.append(current)
+            current = row
+
+    if current:
+        messages.append(current)
+    return messages
+
+
+async def send_rows(update: Update, rows, filename: str = "results.txt") -> None:
+    """
+    Reply with result rows using as few API calls as possible.
+
+    Rows are packed into messages up to Telegram's size limit. When that would
+    still take more than MAX_MESSAGES messages, they are sent as a single text
+    document instead.
+
+    :param update: The update to reply to.
+    :param rows: The rows to send.
+    :param filename: The name of the document used for large result sets.
+    """
+    rows = [str(row) for row in rows]
+    messages = pack_rows(rows)
+
+    if len(messages) <= MAX_MESSAGES:
+        for message in messages:
+            await update.message.reply_text(message)
+        return
+
+    document = io.BytesIO("\n".join(rows).encode("utf-8"))
+    await update.message.reply_document(document=document, filename=filename, caption=f"{len(rows)} results")
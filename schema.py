@@ -0,0 +1,213 @@
+import sqlite3
+
+
+# Table holding the inventory
+TABLE_NAME = "cards"
+
+# Current layout of the inventory table
+CARDS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table_name} (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE COLLATE NOCASE,
+        quantity INTEGER NOT NULL
+    )
+"""
+
+
+def create_cards_table(conn: sqlite3.Connection, table_name: str) -> None:
+    """
+    Bring the inventory table to the current layout.
+
+    The card name is a case-insensitive (NOCASE) unique key, so a plain
+    name = ? is an index seek rather than a LOWER(name) = LOWER(?) scan.
+    The explicit id keeps rowids stable across VACUUM, which the full-text
+    index relies on. Older tables are rebuilt, merging rows that only
+    differ in case.
+    """
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+    ).fetchone()
+
+    if row is None:
+        conn.execute(CARDS_TABLE_SQL.format(table_name=table_name))
+        return
+
+    columns = [column[1] for column in conn.execute(f"PRAGMA table_info({table_name})")]
+    if "COLLATE NOCASE" in row[0].upper() and "id" in columns:
+        return
+
+    conn.execute(CARDS_TABLE_SQL.format(table_name=f"{table_name}_migrated"))
+    conn.execute(f"""
+        INSERT INTO {table_name}_migrated (name, quantity)
+        SELECT LOWER(name), SUM(quantity) FROM {table_name} GROUP BY LOWER(name)
+    """)
+    conn.execute(f"DROP TABLE {table_name}")
+    conn.execute(f"ALTER TABLE {table_name}_migrated RENAME TO {table_name}")
+
+
+def create_search_index(conn: sqlite3.Connection, table_name: str) -> None:
+    """
+    Create the FTS5 trigram index used by /search and the triggers keeping it in sync.
+
+    Skipped when this SQLite build has no FTS5 or trigram tokenizer (SQLite < 3.34),
+    /search then falls back to LIKE.
+    """
+    index_name = f"{table_name}_fts"
+    if _exists(conn, index_name):
+        return
+
+    conn.execute("SAVEPOINT search_index")
+    try:
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE {index_name} USING fts5(
+                name, content='{table_name}', content_rowid='id', tokenize='trigram'
+            )
+        """)
+    except sqlite3.OperationalError:
+        conn.execute("ROLLBACK TO search_index")
+        conn.execute("RELEASE search_index")
+        return
+
+    # Quantity updates do not touch the index, only name changes do
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {index_name}_insert AFTER INSERT ON {table_name} BEGIN
+            INSERT INTO {index_name} (rowid, name) VALUES (new.id, new.name);
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {index_name}_delete AFTER DELETE ON {table_name} BEGIN
+            INSERT INTO {index_name} ({index_name}, rowid, name) VALUES ('delete', old.id, old.name);
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {index_name}_update AFTER UPDATE OF name ON {table_name} BEGIN
+            INSERT INTO {index_name} ({index_name}, rowid, name) VALUES ('delete', old.id, old.name);
+            INSERT INTO {index_name} (rowid, name) VALUES (new.id, new.name);
+        END
+    """)
+    # Index the rows that are already there
+    conn.execute(f"INSERT INTO {index_name} ({index_name}) VALUES ('rebuild')")
+    conn.execute("RELEASE search_index")
+
+
+def create_change_log(conn: sqlite3.Connection, table_name: str) -> None:
+    """
+    Create the change log that versions the inventory, and the triggers that fill it.
+
+    <table_name>_changes keeps one row per card ever touched: its latest
+    quantity (0 once deleted) and the version of that change. Versions grow
+    monotonically, so the delta since version N is every row with a higher
+    version. <table_name>_snapshots names versions for later diffs.
+    """
+    log_name = f"{table_name}_changes"
+    if _exists(conn, log_name):
+        return
+
+    next_version = f"(SELECT COALESCE(MAX(version), 0) + 1 FROM {log_name})"
+    record = f"""
+        INSERT INTO {log_name} (name, quantity, version) VALUES ({{name}}, {{quantity}}, {next_version})
+        ON CONFLICT(name) DO UPDATE SET quantity = excluded.quantity, version = excluded.version;
+    """
+
+    conn.execute(f"""
+        CREATE TABLE {log_name} (
+            name TEXT PRIMARY KEY COLLATE NOCASE,
+            quantity INTEGER NOT NULL,
+            version INTEGER NOT NULL
+        )
+    """)
+    conn.execute(f"CREATE INDEX {log_name}_version ON {log_name} (version)")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table_name}_snapshots (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER {log_name}_insert AFTER INSERT ON {table_name} BEGIN
+            {record.format(name="new.name", quantity="new.quantity")}
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER {log_name}_update AFTER UPDATE OF name, quantity ON {table_name} BEGIN
+            {record.format(name="new.name", quantity="new.quantity")}
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER {log_name}_rename AFTER UPDATE OF name ON {table_name}
+        WHEN old.name <> new.name BEGIN
+            {record.format(name="old.name", quantity="0")}
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER {log_name}_delete AFTER DELETE ON {table_name} BEGIN
+            {record.format(name="old.name", quantity="0")}
+        END
+    """)
+    # Everything already in the inventory is version 1
+    conn.execute(f"INSERT INTO {log_name} (name, quantity, version) SELECT name, quantity, 1 FROM {table_name}")
+
+
+# Ordered schema changes, a database at user_version N has had the first N applied.
+# Only ever append to this list: each step must also cope with files that were
+# set up before user_version was tracked (they are all at 0).
+MIGRATIONS = (
+    create_cards_table,
+    create_search_index,
+    create_change_log,
+)
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection, table_name: str = TABLE_NAME) -> int:
+    """
+    Apply the migrations a database is missing, all in one transaction.
+
+    A database that is already current costs a single PRAGMA read.
+
+    :param conn: An open connection to the database.
+    :param table_name: The name of the inventory table (e.g., 'cards').
+    :return: The number of migrations applied.
+    """
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return 0
+
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # Another connection may have migrated while we waited for the lock
+        version = schema_version(conn)
+        for step in MIGRATIONS[version:]:
+            step(conn, table_name)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return max(SCHEMA_VERSION - version, 0)
+
+
+def change_version(conn: sqlite3.Connection, table_name: str = TABLE_NAME) -> int:
+    """
+    Return the latest version in the change log. Every committed change to the
+    inventory raises it, whichever process or connection made it.
+    """
+    return conn.execute(f"SELECT COALESCE(MAX(version), 0) FROM {table_name}_changes").fetchone()[0]
+
+
+def has_search_index(conn: sqlite3.Connection, table_name: str = TABLE_NAME) -> bool:
+    """
+    Tell whether the FTS5 trigram index exists, it is missing on SQLite builds without it.
+    """
+    return _exists(conn, f"{table_name}_fts")
+
+
+def _exists(conn: sqlite3.Connection, name: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
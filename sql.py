@@ -1,152 +1,338 @@
 import sqlite3
 import os
 import uuid
+import json
+import io
+import gzip
+from collections import namedtuple
 
+from db import connection, get_pool, notify_write
+from createDB import load_csv
+from decklist import parse_decklist
+from fuzzy import get_index, SUGGEST_SCORE
+from cache import get_cache
+from compare_cache import decklist_digest, get_results
+from schema import change_version
+from metrics import timed_query
 
-def add_or_update_quantity(db_name: str, table_name: str,query: str) -> str:
-  
+
+# Closest names offered when /search finds nothing
+SUGGESTION_LIMIT = 5
+
+# Rows fetched from the cursor at a time when exporting
+EXPORT_CHUNK_SIZE = 1000
+
+# Line formats of the exported inventory file
+EXPORT_FORMATS = {
+  "csv": "{name}, {quantity}\n",   # what /add and /compare uploads read
+  "mtgo": "{quantity} {name}\n",   # what convertexport.py reads
+}
+
+# One decklist entry resolved against the inventory. `match` is the inventory card
+# a differently written name was matched to, `suggestion` the closest card when it was not.
+CompareRow = namedtuple("CompareRow", ["name", "wanted", "owned", "needed", "match", "suggestion"], defaults=(None, None))
+
+# One card of one deck when several decks share the inventory. `allocated` is how many
+# owned copies it gets, `demand` how many copies all decks want together.
+AllocationRow = namedtuple("AllocationRow", ["deck", "name", "wanted", "owned", "allocated", "needed", "demand"])
+
+
+def _fetch_quantities(conn, table_name, names) -> dict:
   """
-  Adds a quantity to a record in the database. If the record does not exist, it creates a new one.
-  If the record already exists, it updates the quantity.
+  Fetch the current quantity of every given card with a single query.
+
+  :param conn: An open connection to the database.
+  :param table_name: The name of the table to query (e.g., 'cards').
+  :param names: The card names to look up.
+  :return: A dict mapping the lowercase name to its quantity, for cards that exist.
+  """
+  query = f"SELECT c.name, c.quantity FROM json_each(?) AS j JOIN {table_name} AS c ON c.name = j.value"
+  unique_names = list({name.lower() for name in names})
+  return {name.lower(): quantity for name, quantity in conn.execute(query, (json.dumps(unique_names),))}
+
+def _resolve_missing(conn, db_name, table_name, names, quantities) -> dict:
+  """
+  Map differently written names of cards already in the inventory to the stored name.
+
+  Only names that are the same once punctuation and spacing are dropped
+  ('Sakura Tribe Elder' for 'Sakura-Tribe Elder') are mapped: 'Card 10' is
+  close to 'Card 1' but a different card. This is a dict lookup per name,
+  cheap enough to run inside the write transaction.
 
+  :param conn: An open connection to the database.
   :param db_name: The SQLite database file name (e.g., 'data.db').
   :param table_name: The name of the table to query (e.g., 'cards').
-  :param name: The name of the item to add to.
-  :param query: The card to selectand the quantity to add to the item's current quantity.
-  :return: A message indicating the result of the operation.
+  :param names: The card names of the batch.
+  :param quantities: The result of _fetch_quantities, extended with the resolved cards.
+  :return: A dict mapping the lowercase name to the lowercase stored name.
   """
-  # Connect to the SQLite database
-  conn = sqlite3.connect(db_name)
-  cursor = conn.cursor()
+  index = get_index(db_name, table_name)
+  aliases = {}
 
-  try:
-    # Split the query into name and quantity_to_add
-    name, quantity_to_add = query.rsplit(",", 1)
-    
-    # Check if the name is not null or empty
-    if not name.strip():
-      raise ValueError("The name part of the query is empty")
-    
-    # Check if the quantity is a valid integer
-    quantity_to_add = int(quantity_to_add.strip())
+  for name in {name.lower() for name in names} - quantities.keys():
+    match = index.exact(name)
+    if match is not None and match.lower() != name:
+      aliases[name] = match.lower()
 
-  except ValueError as e:
-        # Handle both cases: empty name and non-integer quantity
-        print(e)
-        return f"An error occurred. Check your query format: [card,quantity]!"
-  
-  #Accessing DB
-  try:
-      # Convert the name to lowercase for consistency
-      lower_name = name.lower()
-      
-      # Check if the record exists and get the current quantity
-      select_query = f"SELECT quantity FROM {table_name} WHERE LOWER(name) = LOWER(?)"
-      cursor.execute(select_query, (lower_name,))
-      result = cursor.fetchone()
-
-      if result:
-          # If the record exists, update the quantity
-          current_quantity = result[0]
-          new_quantity = current_quantity + quantity_to_add
-
-          update_query = f"UPDATE {table_name} SET quantity = ? WHERE LOWER(name) = LOWER(?)"
-          cursor.execute(update_query, (new_quantity, lower_name))
-
-          conn.commit()
-          
-          return f"Updated '{name}': quantity {current_quantity} -> {new_quantity}"
+  if aliases:
+    quantities.update(_fetch_quantities(conn, table_name, aliases.values()))
+  return aliases
+
+def _resolved_as(name, aliases) -> str:
+  # Tell the user when a line was applied to a differently written card
+  match = aliases.get(name.lower())
+  return f" (as \"{match}\")" if match else ""
+
+def _store_quantities(conn, table_name, quantities) -> None:
+  """
+  Write the final quantity of every touched card in bulk.
+  Cards that reach 0 or less are purged with a single DELETE.
+
+  :param conn: An open connection to the database, inside a transaction.
+  :param table_name: The name of the table to update (e.g., 'cards').
+  :param quantities: A dict mapping the lowercase name to its new quantity.
+  """
+  upsert_query = f"""
+    INSERT INTO {table_name} (name, quantity) VALUES (?, ?)
+    ON CONFLICT(name) DO UPDATE SET quantity = excluded.quantity
+  """
+  conn.executemany(upsert_query, [(name, quantity) for name, quantity in quantities.items() if quantity > 0])
+
+  purged = [name for name, quantity in quantities.items() if quantity <= 0]
+  if purged:
+    delete_query = f"DELETE FROM {table_name} WHERE name IN (SELECT value FROM json_each(?))"
+    conn.execute(delete_query, (json.dumps(purged),))
+
+@timed_query
+def bulk_add(db_name, table_name, cards) -> list:
+  """
+  Add a batch of cards to the database in one transaction.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to insert into (e.g., 'cards').
+  :param cards: A list of (name, quantity) tuples, see decklist.parse_decklist.
+  :return: One report line per card.
+  """
+  formatted = []
+
+  with connection(db_name) as conn:
+    conn.execute("BEGIN IMMEDIATE")
+    quantities = _fetch_quantities(conn, table_name, [name for name, _ in cards])
+    aliases = _resolve_missing(conn, db_name, table_name, [name for name, _ in cards], quantities)
+
+    for name, quantity in cards:
+      lower_name = aliases.get(name.lower(), name.lower())
+      quantities[lower_name] = quantities.get(lower_name, 0) + quantity
+      formatted.append(f"Added \"{name}\": quantity {quantity}{_resolved_as(name, aliases)}")
+
+    _store_quantities(conn, table_name, quantities)
+    conn.commit()
+
+  notify_write(db_name, table_name, quantities)
+
+  return formatted
+
+@timed_query
+def bulk_remove(db_name, table_name, cards) -> list:
+  """
+  Remove a batch of cards from the database in one transaction.
+  Cards that are not in the inventory are skipped.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to update (e.g., 'cards').
+  :param cards: A list of (name, quantity) tuples, see decklist.parse_decklist.
+  :return: One report line per card that was found, or that was not but has a close match.
+  """
+  formatted = []
+  skipped = []  # (position in formatted, name) of the cards that were not found
+
+  with connection(db_name) as conn:
+    conn.execute("BEGIN IMMEDIATE")
+    quantities = _fetch_quantities(conn, table_name, [name for name, _ in cards])
+    aliases = _resolve_missing(conn, db_name, table_name, [name for name, _ in cards], quantities)
+    touched = {}
+
+    for name, quantity in cards:
+      lower_name = aliases.get(name.lower(), name.lower())
+      current_quantity = touched.get(lower_name, quantities.get(lower_name, 0))
+      if current_quantity > 0:
+        touched[lower_name] = current_quantity - quantity
+        formatted.append(f"Removed \"{name}\": quantity {quantity}{_resolved_as(name, aliases)}")
       else:
-          # If the record does not exist, insert a new one
-          insert_query = f"INSERT INTO {table_name} (name, quantity) VALUES (?, ?)"
-          cursor.execute(insert_query, (lower_name, quantity_to_add))
+        skipped.append((len(formatted), name))
+        formatted.append(None)
 
-          conn.commit()
+    _store_quantities(conn, table_name, touched)
+    conn.commit()
 
-          return f"Added '{name}' with quantity {quantity_to_add}"
+  notify_write(db_name, table_name, touched)
 
-  except sqlite3.Error as e:
-      return [f"An error occurred: {e}"]
+  # Fuzzy suggestions are slow, look them up once the write lock is released
+  index = get_index(db_name, table_name)
+  for position, name in skipped:
+    suggestion = index.suggest(name)
+    if suggestion is not None:
+      formatted[position] = f"Skipped \"{name}\": not in the inventory (did you mean \"{suggestion}\"?)"
+  formatted = [line for line in formatted if line is not None]
 
-  finally:
-      # Ensure the connection is closed
-      conn.close()
+  return formatted
 
-def subtract_quantity(db_name: str, table_name: str, query: str) -> str:
+@timed_query
+def bulk_add_diff(db_name, table_name, cards) -> tuple:
   """
-  Subtracts a quantity from a record in the database and removes the record if the resulting quantity is 0 or less.
+  Top up a batch of cards so the inventory holds at least the listed quantity.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to update (e.g., 'cards').
+  :param cards: A list of (name, quantity) tuples, see decklist.parse_decklist.
+  :return: The report lines and the number of cards that were already owned.
+  """
+  formatted = []
+  owned = 0
+
+  with connection(db_name) as conn:
+    conn.execute("BEGIN IMMEDIATE")
+    quantities = _fetch_quantities(conn, table_name, [name for name, _ in cards])
+    aliases = _resolve_missing(conn, db_name, table_name, [name for name, _ in cards], quantities)
+    touched = {}
+
+    for name, quantity in cards:
+      lower_name = aliases.get(name.lower(), name.lower())
+      current_quantity = touched.get(lower_name, quantities.get(lower_name, 0))
+
+      if current_quantity <= 0:
+        touched[lower_name] = quantity
+        formatted.append(f"Added \"{name}\": quantity {quantity}{_resolved_as(name, aliases)}")
+      elif quantity > current_quantity:
+        touched[lower_name] = quantity
+        formatted.append(f"Updated \"{name}\": quantity {current_quantity} -> {quantity}{_resolved_as(name, aliases)}")
+      else:
+        owned += 1
+
+    _store_quantities(conn, table_name, touched)
+    conn.commit()
+
+  notify_write(db_name, table_name, touched)
+
+  return formatted, owned
+
+
+# Reply to an /add or /remove query that is not "name, quantity"
+QUERY_FORMAT_ERROR = "An error occurred. Check your query format: [card,quantity]!"
+
+def parse_card_query(query: str) -> tuple:
+  """
+  Parse the argument of a single-card /add or /remove command.
+
+  :param query: A query such as 'Sakura-Tribe Elder, 2'.
+  :return: A (name, quantity) tuple.
+  :raises ValueError: If the name is empty or the quantity is not an integer.
+  """
+  # Split the query into name and quantity
+  name, quantity = query.rsplit(",", 1)
+
+  # Check if the name is not null or empty
+  if not name.strip():
+    raise ValueError("The name part of the query is empty")
+
+  # Check if the quantity is a valid integer
+  return name, int(quantity.strip())
+
+@timed_query
+def apply_card_changes(db_name, table_name, changes) -> list:
+  """
+  Apply single-card additions and subtractions in one transaction.
+
+  The changes are replayed in order, so every one gets the reply it would
+  have had on its own, but the batch costs a single commit.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to update (e.g., 'cards').
+  :param changes: A list of (operation, name, quantity) tuples, operation being 'add' or 'remove'.
+  :return: One reply per change, in the same order.
+  """
+  replies = []
+
+  with connection(db_name) as conn:
+    try:
+      conn.execute("BEGIN IMMEDIATE")
+      quantities = _fetch_quantities(conn, table_name, [name for _, name, _ in changes])
+      touched = {}
+
+      for operation, name, quantity in changes:
+        # Convert the name to lowercase for consistency
+        lower_name = name.lower()
+        current_quantity = touched.get(lower_name, quantities.get(lower_name, 0))
+
+        if operation == "add":
+          if current_quantity > 0:
+            touched[lower_name] = current_quantity + quantity
+            replies.append(f"Updated '{name}': quantity {current_quantity} -> {current_quantity + quantity}")
+          else:
+            touched[lower_name] = quantity
+            replies.append(f"Added '{name}' with quantity {quantity}")
+
+        elif current_quantity <= 0:
+          replies.append(f"No record found for '{name}' to subtract the quantity.")
+        elif current_quantity - quantity > 0:
+          touched[lower_name] = current_quantity - quantity
+          replies.append("Updated {}: quanity {} -> {}".format(name, current_quantity, current_quantity - quantity))
+        else:
+          # The record is removed once the quantity is 0 or less
+          touched[lower_name] = 0
+          replies.append("Removed {}".format(name))
+
+      _store_quantities(conn, table_name, touched)
+      conn.commit()
+
+    except sqlite3.Error as e:
+      return [f"An error occurred: {e}"] * len(changes)
+
+  notify_write(db_name, table_name, touched)
+
+  return replies
+
+@timed_query
+def add_or_update_quantity(db_name: str, table_name: str,query: str) -> str:
+
+  """
+  Adds a quantity to a record in the database. If the record does not exist, it creates a new one.
+  If the record already exists, it updates the quantity.
 
   :param db_name: The SQLite database file name (e.g., 'data.db').
   :param table_name: The name of the table to query (e.g., 'cards').
-  :param name: The name of the item to subtract from.
-  :param quantity_to_subtract: The quantity to subtract from the item's current quantity.
+  :param query: The card to select and the quantity to add to the item's current quantity.
+  :return: A message indicating the result of the operation.
   """
-  
-  
-  
   try:
-    # Split the query into name and quantity_to_add
-    name, quantity_to_subtract = query.rsplit(",", 1)
-    
-    # Check if the name is not null or empty
-    if not name.strip():
-      raise ValueError("The name part of the query is empty")
-    
-    # Check if the quantity is a valid integer
-    quantity_to_subtract = int(quantity_to_subtract.strip())
-
+    name, quantity_to_add = parse_card_query(query)
   except ValueError as e:
     # Handle both cases: empty name and non-integer quantity
     print(e)
-    return f"An error occurred. Check your query format: [card,quantity]!"
-  
-  
-  
-  
-  # Connect to the SQLite database
-  conn = sqlite3.connect(db_name)
-  cursor = conn.cursor()
+    return QUERY_FORMAT_ERROR
+
+  return apply_card_changes(db_name, table_name, [("add", name, quantity_to_add)])[0]
 
+@timed_query
+def subtract_quantity(db_name: str, table_name: str, query: str) -> str:
+  """
+  Subtracts a quantity from a record in the database and removes the record if the resulting quantity is 0 or less.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to query (e.g., 'cards').
+  :param query: The card to select and the quantity to subtract from the item's current quantity.
+  :return: A message indicating the result of the operation.
+  """
   try:
-      # Convert the name to lowercase for consistency
-      lower_name = name.lower()
-
-      # Check if the record exists and get the current quantity
-      select_query = f"SELECT quantity FROM {table_name} WHERE LOWER(name) = LOWER(?)"
-      cursor.execute(select_query, (lower_name,))
-      result = cursor.fetchone()
-
-      if result:
-          current_quantity = result[0]
-
-          # Calculate the new quantity after subtraction
-          new_quantity = current_quantity - quantity_to_subtract
-
-          if new_quantity > 0:
-            # Update the record with the new quantity
-            update_query = f"UPDATE {table_name} SET quantity = ? WHERE LOWER(name) = LOWER(?)"
-            cursor.execute(update_query, (new_quantity, lower_name))
-            
-            conn.commit()
-            
-            return "Updated {}: quanity {} -> {}".format(name, current_quantity, new_quantity)
-          else:
-            # Remove the record from the table if the quantity is 0 or less
-            delete_query = f"DELETE FROM {table_name} WHERE LOWER(name) = LOWER(?)"
-            cursor.execute(delete_query, (lower_name,))
-            
-            conn.commit()
-            conn.close()
-            return "Removed {}".format(name)
-              
-      else:
-          conn.close()
-          return f"No record found for '{name}' to subtract the quantity."
+    name, quantity_to_subtract = parse_card_query(query)
+  except ValueError as e:
+    # Handle both cases: empty name and non-integer quantity
+    print(e)
+    return QUERY_FORMAT_ERROR
 
-  except sqlite3.Error as e:
-      conn.close()
-      return [f"An error occurred: {e}"]
+  return apply_card_changes(db_name, table_name, [("remove", name, quantity_to_subtract)])[0]
 
+@timed_query
 def search_card(db_name, table_name, column_name, substring) -> str:
   """
   Select all rows from the specified table where the column contains a given substring.
@@ -157,40 +343,60 @@ def search_card(db_name, table_name, column_name, substring) -> str:
   :param substring: The substring to search for within the column.
   :return: A list of tuples containing the matching rows.
   """
-  
-  formatted = []
 
-  # Connect to the SQLite database
-  conn = sqlite3.connect(db_name)
-  cursor = conn.cursor()
+  formatted = []
 
-  # SQL query to select all rows where the column contains the substring
-  query = f"SELECT * FROM {table_name} WHERE {column_name} LIKE ?"
+  # Borrow a pooled connection to the SQLite database
+  with connection(db_name) as conn:
+    cursor = conn.cursor()
 
-  # The '%' wildcard matches any sequence of characters
-  search_pattern = f"%{substring}%"
+    # The trigram index only knows substrings of 3 characters or more
+    if get_pool(db_name).search_index and len(substring) >= 3:
+      # Quote the substring so FTS5 treats it as one phrase, best matches first
+      query = f"""
+        SELECT c.{column_name}, c.quantity FROM {table_name}_fts AS f
+        JOIN {table_name} AS c ON c.id = f.rowid
+        WHERE {table_name}_fts MATCH ? ORDER BY f.rank, c.{column_name}
+      """
+      search_pattern = '"{}"'.format(substring.replace('"', '""'))
+    else:
+      # SQL query to select all rows where the column contains the substring
+      query = f"SELECT {column_name}, quantity FROM {table_name} WHERE {column_name} LIKE ?"
 
-  # Execute the query with the search pattern as the parameter
-  cursor.execute(query, (search_pattern,))
+      # The '%' wildcard matches any sequence of characters
+      search_pattern = f"%{substring}%"
 
-  # Fetch all matching rows
-  results = cursor.fetchall()
+    # Execute the query with the search pattern as the parameter
+    cursor.execute(query, (search_pattern,))
 
-  # Close the connection
-  conn.close()
+    # Fetch all matching rows
+    results = cursor.fetchall()
 
 
   if len(results)==0:
-    return "No results..."
-  
+    return _suggest_cards(db_name, table_name, substring)
+
   # Print the matching rows
   for row in results:
     #print(row)
     formatted.append("Found {} -> you have {}".format(row[0],row[1]))
     #print(formatted)
-  
+
   return formatted
- 
+
+def _suggest_cards(db_name, table_name, substring):
+  """
+  Offer the closest card names when a search finds nothing, e.g. because of a typo.
+  """
+  matches = [name for name, score in get_index(db_name, table_name).closest(substring, limit=SUGGESTION_LIMIT) if score >= SUGGEST_SCORE]
+  if not matches:
+    return "No results..."
+
+  quantities = _cached_quantities(db_name, table_name, matches)
+
+  return ["Did you mean {} -> you have {}".format(name, quantities[name.lower()]) for name in matches if quantities[name.lower()] > 0] or "No results..."
+
+@timed_query
 def add_cards_from_file(db_name, table_name, file_path) -> str:
   """
   Add cards from a text file to the database.
@@ -200,53 +406,195 @@ def add_cards_from_file(db_name, table_name, file_path) -> str:
   :param file_path: The path to the text file containing the cards to add.
   :return: A message indicating the result of the operation.
   """
-  conn = sqlite3.connect(db_name)
-  cursor = conn.cursor()
+  try:
+    formatted = bulk_add(db_name, table_name, parse_decklist(file_path))
 
-  formatted = []
+    return formatted if formatted else "No cards added."
 
-  try:
-    file_path =  file_path.replace("\r", "")# Remove carriage return characters because Windows
-    lines = file_path.split("\n")
+  except Exception as e:
+    return [f"An error occurred: {e}"]
 
-    # Process each line
-    for line in lines:
-      # Split the line into name and quantity
-      name, quantity = line.rsplit(",", 1)
+def _cached_quantities(db_name, table_name, names, cache=None) -> dict:
+  """
+  Look up card quantities through the inventory cache.
+  Only names the cache cannot answer are read from the database, in one query.
 
-      # Convert the name to lowercase for consistency
-      lower_name = name.lower()
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to query (e.g., 'cards').
+  :param names: The card names to look up.
+  :param cache: The inventory cache when the caller already has it, otherwise it is brought up to date first.
+  :return: A dict mapping the lowercase name to its quantity, 0 when not owned.
+  """
+  if cache is None:
+    cache = get_cache(db_name, table_name)
+  version = cache.version
+  quantities, unknown = cache.lookup(names)
+
+  if unknown:
+    with connection(db_name) as conn:
+      found = _fetch_quantities(conn, table_name, unknown)
+    cache.fill(unknown, found, version)
+    for name in unknown:
+      quantities[name] = found.get(name, 0)
+
+  return quantities
+
+@timed_query
+def compare_decklist(db_name, table_name, column_name, cards) -> list:
+  """
+  Resolve owned and needed quantities for a whole decklist.
 
-      # Check if the record exists and get the current quantity
-      select_query = f"SELECT quantity FROM {table_name} WHERE LOWER(name) = LOWER(?)"
-      cursor.execute(select_query, (lower_name,))
-      result = cursor.fetchone()
+  Quantities come from the inventory cache, cards it does not hold are read
+  with a single query, so the comparison costs at most one round trip however
+  long the list is.
 
-      if result:
-        current_quantity = result[0]
-        new_quantity = current_quantity + int(quantity.strip())
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to query (e.g., 'cards').
+  :param column_name: The name of the column to match (e.g., 'name').
+  :param cards: A list of (name, quantity) tuples, see decklist.parse_decklist.
+  :return: A list of CompareRow in decklist order.
+  """
+  if not cards:
+    return []
+  _, rows, _ = compare_entry(db_name, table_name, column_name, cards)
+  return rows
 
-        # Update the record with the new quantity
-        update_query = f"UPDATE {table_name} SET quantity = ? WHERE LOWER(name) = LOWER(?)"
-        cursor.execute(update_query, (new_quantity, lower_name))
-      else:
-        # Insert a new record if it does not exist
-        insert_query = f"INSERT INTO {table_name} (name, quantity) VALUES (?, ?)"
-        cursor.execute(insert_query, (lower_name, quantity.strip()))
+def compare_entry(db_name, table_name, column_name, cards) -> tuple:
+  """
+  Compare a decklist like compare_decklist, also returning where the result is cached.
 
-      formatted.append(f"Added \"{name}\": quantity {quantity.strip()}")
-    # Commit the changes
-    conn.commit()
+  The inventory version is read once and used for both the key and the cache check.
 
-    return formatted if formatted else "No cards added."
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to query (e.g., 'cards').
+  :param column_name: The name of the column to match (e.g., 'name').
+  :param cards: A list of (name, quantity) tuples, see decklist.parse_decklist.
+  :return: The cache key (see compare_cache.CompareCache), the list of CompareRow
+           and the compare_cache.CompareEntry holding them, None when they were not memoized.
+  """
+  # The same decklist against the same inventory version was already compared
+  generation = get_results().generation(db_name, table_name)
+  key = compare_version_key(db_name, table_name, decklist_digest(cards))
+  entry = get_results().get(key)
+  if entry is not None:
+    return key, list(entry.rows), entry
+  # Brought up to the change log, also after writes made outside sql.py
+  cache = get_cache(db_name, table_name, key[3])
+
+  quantities = _cached_quantities(db_name, table_name, [name for name, _ in cards], cache)
+
+  # Differently written names ('Sakura Tribe Elder') count as the owned card, like
+  # the writes do. Anything looser ('Card 10' for 'Card 1') is only suggested
+  index = get_index(db_name, table_name)
+  matches = {}
+  suggestions = {}
+  for name, _ in cards:
+    if quantities[name.lower()] > 0 or name in matches or name in suggestions:
+      continue
+    match = index.exact(name)
+    if match is not None and match.lower() != name.lower():
+      matches[name] = match
+    else:
+      suggestions[name] = index.suggest(name)
+  if matches:
+    quantities.update(_cached_quantities(db_name, table_name, matches.values(), cache))
+
+  rows = []
+  for name, wanted in cards:
+    match = matches.get(name)
+    owned = quantities[(match or name).lower()]
+    rows.append(CompareRow(name, wanted, owned, max(wanted - owned, 0), match, suggestions.get(name)))
+  # Only memoized when computed from the inventory at exactly the version of the key
+  entry = None
+  if cache.change_version == key[3]:
+    entry = get_results().put(key, rows, generation)
+  return key, rows, entry
+
+def compare_version_key(db_name, table_name, digest) -> tuple:
+  """
+  Return the cache key of an already hashed decklist against the current inventory version.
+  """
+  with connection(db_name) as conn:
+    version = change_version(conn, table_name)
+  return db_name, table_name, digest, version
 
-  except Exception as e:
-    return [f"An error occurred: {e}"]
+def format_compare_row(row) -> str:
+  """
+  Format a CompareRow the way /compare reports it.
+  """
+  if row.match:
+    return f"Found \"{row.name}\" as \"{row.match}\": you need {row.needed}"
+  if row.suggestion:
+    return f"Found \"{row.name}\": you need {row.needed} (did you mean \"{row.suggestion}\"?)"
+  return f"Found \"{row.name}\": you need {row.needed}"
+
+@timed_query
+def allocate_decklists(db_name, table_name, decks) -> list:
+  """
+  Share the inventory between several decklists, e.g. decks built from the same collection.
+
+  Demand is aggregated per card over every deck in a single query, and owned
+  copies go to the decks in the order given, so a card is never counted twice.
+  Names are matched exactly (ignoring case).
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to query (e.g., 'cards').
+  :param decks: A list of (deck name, cards) tuples, cards as in compare_decklist.
+  :return: A list of AllocationRow, deck by deck in decklist order.
+  """
+  entries = [(deck, name, quantity) for deck, cards in decks for name, quantity in cards]
+  if not entries:
+    return []
+
+  # Running demand per card, in deck order: a deck gets what the decks before it left
+  query = f"""
+    WITH demand AS (
+      SELECT key AS position, json_extract(value, '$[0]') AS name, json_extract(value, '$[1]') AS wanted
+      FROM json_each(?)
+    )
+    SELECT MAX(COALESCE(c.quantity, 0), 0),
+           SUM(d.wanted) OVER (PARTITION BY d.name ORDER BY d.position),
+           SUM(d.wanted) OVER (PARTITION BY d.name)
+    FROM demand AS d LEFT JOIN {table_name} AS c ON c.name = d.name
+    ORDER BY d.position
+  """
+  demand = json.dumps([[name.strip().lower(), quantity] for _, name, quantity in entries])
+  with connection(db_name) as conn:
+    results = conn.execute(query, (demand,)).fetchall()
 
-  finally:
-    # Close the database connection
-    conn.close()  
-  
+  rows = []
+  for (deck, name, wanted), (owned, running, total) in zip(entries, results):
+    allocated = max(min(wanted, owned - (running - wanted)), 0)
+    rows.append(AllocationRow(deck, name.strip(), wanted, owned, allocated, wanted - allocated, total))
+  return rows
+
+def format_allocation(rows) -> list:
+  """
+  Format allocate_decklists results: the cards several decks are short of, then what each deck still needs.
+  """
+  decks = {}
+  wanted_by = {}
+  for row in rows:
+    decks.setdefault(row.deck, []).append(row)
+    wanted_by.setdefault(row.name.lower(), (row, set()))[1].add(row.deck)
+
+  lines = []
+  shared = [(row, len(names)) for row, names in wanted_by.values() if len(names) > 1 and row.demand > row.owned]
+  if shared:
+    lines.append("Shared shortfalls:")
+    for row, count in shared:
+      lines.append(f"{row.name}: {row.demand} wanted by {count} decks, you have {row.owned}, {row.demand - row.owned} short")
+
+  for deck, deck_rows in decks.items():
+    missing = [row for row in deck_rows if row.needed > 0]
+    if not missing:
+      lines.append(f"{deck}: complete")
+      continue
+    lines.append(f"{deck}: needs {sum(row.needed for row in missing)} cards")
+    lines += [f"{row.needed} {row.name}" for row in missing]
+  return lines
+
+@timed_query
 def search_card_exact_and_compare(db_name, table_name, column_name, file_path) -> str:
   """
   Compare rows in a text file with entries in the database and return matching rows.
@@ -258,44 +606,16 @@ def search_card_exact_and_compare(db_name, table_name, column_name, file_path) -
   :return: A list of formatted strings containing the matching rows.
   """
 
-  formatted = []
-  
-  # Connect to the SQLite database
-  conn = sqlite3.connect(db_name)
-  cursor = conn.cursor()
-
   try:
-    file_path =  file_path.replace("\r", "")# Remove carriage return characters because Windows
-    cards = file_path.split("\n")
-
-    for card in cards:
-      # Split the card into name and quantity
-      name, quantity = card.rsplit(",", 1)
-
-      # Convert the name to lowercase for consistency
-      lower_name = name.lower()
-
-      # Check if the record exists and get the current quantity
-      select_query = f"SELECT quantity FROM {table_name} WHERE LOWER({column_name}) = LOWER(?)"
-      cursor.execute(select_query, (lower_name,))
-      result = cursor.fetchone()
-
-      if result:
-        current_quantity = result[0]
-        current_quantity = int(quantity.strip()) - current_quantity
-        formatted.append(f"Found \"{name}\": you need {current_quantity if current_quantity > 0 else 0}")
-      else:
-        formatted.append(f"Found \"{name}\": you need {quantity.strip()}")
-
+    rows = compare_decklist(db_name, table_name, column_name, parse_decklist(file_path))
   except Exception as e:
-      return [f"An error occurred: {e}"]
+    return [f"An error occurred: {e}"]
 
-  finally:
-      # Close the database connection
-      conn.close()
+  formatted = [format_compare_row(row) for row in rows]
 
   return formatted if formatted else "No matches found."
 
+@timed_query
 def remove_cards_from_file(db_name, table_name, file_path) -> str:
   """
   Remove cards from a text file from the database.
@@ -305,51 +625,196 @@ def remove_cards_from_file(db_name, table_name, file_path) -> str:
   :param file_path: The path to the text file containing the cards to remove.
   :return: A message indicating the result of the operation.
   """
-  conn = sqlite3.connect(db_name)
-  cursor = conn.cursor()
-
-  formatted = []
-
   try:
-    file_path =  file_path.replace("\r", "")# Remove carriage return characters because Windows
-    lines = file_path.split("\n")
-
-    # Process each line
-    for line in lines:
-      name, quantity = line.rsplit(",", 1)
-      lower_name = name.lower()
-
-      # Check if the record exists and get the current quantity
-      select_query = f"SELECT quantity FROM {table_name} WHERE LOWER(name) = LOWER(?)"
-      cursor.execute(select_query, (lower_name,))
-      result = cursor.fetchone()
-
-      if result:
-        current_quantity = result[0]
-        new_quantity = current_quantity - int(quantity.strip())
-
-        if new_quantity > 0:
-          # Update the record with the new quantity
-          update_query = f"UPDATE {table_name} SET quantity = ? WHERE LOWER(name) = LOWER(?)"
-          cursor.execute(update_query, (new_quantity, lower_name))
-        else:
-          # Remove the record from the table if the quantity is 0 or less
-          delete_query = f"DELETE FROM {table_name} WHERE LOWER(name) = LOWER(?)"
-          cursor.execute(delete_query, (lower_name,))
-
-        formatted.append(f"Removed \"{name}\": quantity {quantity.strip()}")
-    # Commit the changes
-    conn.commit()
+    formatted = bulk_remove(db_name, table_name, parse_decklist(file_path))
 
     return formatted if formatted else ["No cards removed."]
 
   except Exception as e:
     return [f"An error occurred: {e}"]
 
-  finally:
-    # Close the database connection
-    conn.close()
+@timed_query
+def remove_card(db_name, table_name, name) -> str:
+  """
+  Remove every copy of a card from the database.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to update (e.g., 'cards').
+  :param name: The name of the card to remove.
+  :return: A message indicating the result of the operation.
+  """
+  name = name.strip()
+
+  with connection(db_name) as conn:
+    removed = conn.execute(f"DELETE FROM {table_name} WHERE name = ?", (name.lower(),)).rowcount
+    conn.commit()
+
+  if not removed:
+    return f"No record found for '{name}'."
+
+  notify_write(db_name, table_name, {name.lower(): 0})
+  return "Removed {}".format(name)
+
+@timed_query
+def reset_inventory(db_name, table_name, backup=True) -> int:
+  """
+  Remove every card from the database in a single transaction.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to clear (e.g., 'cards').
+  :param backup: Copy the current rows to '<table_name>_backup' first, replacing the previous backup.
+  :return: The number of rows removed.
+  """
+  with connection(db_name) as conn:
+    conn.execute("BEGIN IMMEDIATE")
+    if backup:
+      conn.execute(f"DROP TABLE IF EXISTS {table_name}_backup")
+      conn.execute(f"CREATE TABLE {table_name}_backup AS SELECT name, quantity FROM {table_name}")
+    removed = conn.execute(f"DELETE FROM {table_name}").rowcount
+    conn.commit()
+
+  notify_write(db_name, table_name, None)
+  return removed
+
+@timed_query
+def import_inventory(db_name, table_name, lines) -> tuple:
+  """
+  Bulk load a CSV collection export, adding its quantities to the inventory.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to load into (e.g., 'cards').
+  :param lines: The CSV lines, with or without a header row.
+  :return: The number of rows loaded and the seconds it took.
+  :raises ValueError: If a row cannot be read, nothing is loaded then.
+  """
+  count, seconds = load_csv(db_name, lines, table_name)
+  if count:
+    notify_write(db_name, table_name, None)
+  return count, seconds
+
+def iter_inventory(db_name, table_name, chunk_size=EXPORT_CHUNK_SIZE):
+  """
+  Yield the inventory in chunks of (name, quantity) rows, straight from a cursor.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to read (e.g., 'cards').
+  :param chunk_size: The number of rows per chunk.
+  """
+  with connection(db_name) as conn:
+    cursor = conn.execute(f"SELECT name, quantity FROM {table_name} ORDER BY name")
+    try:
+      while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+          break
+        yield rows
+    finally:
+      cursor.close()
+
+@timed_query
+def export_inventory(db_name, table_name, export_format="csv", compress=False) -> tuple:
+  """
+  Export the inventory into an in-memory buffer, ready to be uploaded.
+
+  Rows are streamed from the cursor and encoded chunk by chunk, so only the
+  (optionally gzipped) output itself is held in memory and nothing touches disk.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the table to read (e.g., 'cards').
+  :param export_format: One of EXPORT_FORMATS: 'csv' ("name, N") or 'mtgo' ("N name").
+  :param compress: Gzip the output.
+  :return: The buffer positioned at its start, and the number of rows written.
+  """
+  line_format = EXPORT_FORMATS[export_format]
+  buffer = io.BytesIO()
+  output = gzip.GzipFile(fileobj=buffer, mode="wb") if compress else buffer
+  count = 0
+
+  for rows in iter_inventory(db_name, table_name):
+    output.write("".join(line_format.format(name=name, quantity=quantity) for name, quantity in rows).encode("utf-8"))
+    count += len(rows)
+
+  if compress:
+    output.close()
+  buffer.seek(0)
+  return buffer, count
+
+@timed_query
+def inventory_version(db_name, table_name) -> int:
+  """
+  Return the current version of the inventory. It grows with every change.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the versioned table (e.g., 'cards').
+  """
+  with connection(db_name) as conn:
+    return change_version(conn, table_name)
+
+@timed_query
+def create_snapshot(db_name, table_name, name) -> int:
+  """
+  Name the current version, so /changes can diff against it later.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the versioned table (e.g., 'cards').
+  :param name: The snapshot name. An existing snapshot with that name is moved.
+  :return: The version the snapshot points at.
+  """
+  with connection(db_name) as conn:
+    version = change_version(conn, table_name)
+    conn.execute(f"""
+      INSERT INTO {table_name}_snapshots (name, version) VALUES (?, ?)
+      ON CONFLICT(name) DO UPDATE SET version = excluded.version, created = CURRENT_TIMESTAMP
+    """, (name, version))
+    conn.commit()
+  return version
+
+@timed_query
+def changes_since(db_name, table_name, since) -> tuple:
+  """
+  Return what changed in the inventory after a version or a named snapshot.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the versioned table (e.g., 'cards').
+  :param since: A version number, or the name of a snapshot.
+  :return: The version diffed from, the current version and a list of (name, quantity)
+           rows with each changed card's current quantity (0 when it was removed).
+  :raises ValueError: If `since` is neither a number nor a known snapshot.
+  """
+  with connection(db_name) as conn:
+    if isinstance(since, int) or str(since).isdigit():
+      since = int(since)
+    else:
+      row = conn.execute(f"SELECT version FROM {table_name}_snapshots WHERE name = ?", (since,)).fetchone()
+      if row is None:
+        raise ValueError(f"No snapshot named '{since}'.")
+      since = row[0]
+
+    # A single read transaction, so the rows and the version agree
+    conn.execute("BEGIN")
+    rows = conn.execute(f"SELECT name, quantity FROM {table_name}_changes WHERE version > ? ORDER BY version", (since,)).fetchall()
+    version = change_version(conn, table_name)
+    conn.commit()
 
+  return since, version, rows
+
+@timed_query
+def export_changes(db_name, table_name, since, export_format="csv") -> tuple:
+  """
+  Export the changes since a version or snapshot into an in-memory buffer.
+
+  :param db_name: The SQLite database file name (e.g., 'data.db').
+  :param table_name: The name of the versioned table (e.g., 'cards').
+  :param since: A version number, or the name of a snapshot.
+  :param export_format: One of EXPORT_FORMATS.
+  :return: The buffer, the version diffed from, the current version and the number of rows.
+  """
+  since, version, rows = changes_since(db_name, table_name, since)
+  line_format = EXPORT_FORMATS[export_format]
+  buffer = io.BytesIO("".join(line_format.format(name=name, quantity=quantity) for name, quantity in rows).encode("utf-8"))
+  return buffer, since, version, len(rows)
+
+@timed_query
 def return_inventory_file(db_name, table_name, directory) -> str:
     """
     Return the inventory from the database to a text file.
@@ -359,33 +824,25 @@ def return_inventory_file(db_name, table_name, directory) -> str:
     :param directory: The directory where the text file should be created.
     :return: A message indicating the result of the operation.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    try:
-        # SQL query to select all rows from the table
-        query = f"SELECT * FROM {table_name}"
-        cursor.execute(query)
-
-        # Fetch all rows
-        results = cursor.fetchall()
-
-        if not results:
-            return "No inventory to write."
-
-        # Generate a unique file name
-        file_name = f"inventory_{uuid.uuid4().hex}.txt"
-        file_path = os.path.join(directory, file_name)
-
-        # Write the inventory to the file
-        with open(file_path, "w") as file:
-            for row in results:
+    # Generate a unique file name
+    file_name = f"inventory_{uuid.uuid4().hex}.txt"
+    file_path = os.path.join(directory, file_name)
+    count = 0
+
+    # Write the inventory to the file as it is read
+    with open(file_path, "w") as file:
+        for rows in iter_inventory(db_name, table_name):
+            for row in rows:
                 file.write(f"{row[0]} {row[1]}\n")
+            count += len(rows)
 
-        return f"{file_path}"
-    finally:
-        conn.close()
+    if not count:
+        os.remove(file_path)
+        return "No inventory to write."
+
+    return f"{file_path}"
 
+@timed_query
 def add_diff(db_name, table_name, file_path) -> str:
     """
     Add the difference between the database and a text file to the database.
@@ -395,59 +852,19 @@ def add_diff(db_name, table_name, file_path) -> str:
     :param file_path: The path to the text file containing the cards to compare.
     :return: A message indicating the result of the operation.
     """
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    formatted = []
-
     try:
-        file_path =  file_path.replace("\r", "")# Remove carriage return characters because Windows
-        lines = file_path.split("\n")
-        owned = []
-        # Process each line
-        for line in lines:
-            name, quantity = line.rsplit(",", 1)
-            lower_name = name.lower()
-
-            # Check if the record exists and get the current quantity
-            select_query = f"SELECT quantity FROM {table_name} WHERE LOWER(name) = LOWER(?)"
-            cursor.execute(select_query, (lower_name,))
-            result = cursor.fetchone()
-
-            if result:
-                current_quantity = result[0]
-                new_quantity = int(quantity.strip()) - current_quantity
-
-                if new_quantity > 0:
-                    # Update the record with the new quantity
-                    update_query = f"UPDATE {table_name} SET quantity = ? WHERE LOWER(name) = LOWER(?)"
-                    cursor.execute(update_query, (new_quantity, lower_name))
-                    formatted.append(f"Updated \"{name}\": quantity {current_quantity} -> {new_quantity.strip()}")
-                else:
-                    owned.append(f"{name}")
-
-            else:
-                # Insert a new record if it does not exist
-                insert_query = f"INSERT INTO {table_name} (name, quantity) VALUES (?, ?)"
-                cursor.execute(insert_query, (lower_name, quantity.strip()))
-                formatted.append(f"Added \"{name}\": quantity {quantity.strip()}")
-
-        # Commit the changes
-        conn.commit()
-        if owned == []:
-            return ["No differences added."]
-        else:
-          if len(owned) == len(lines):
+        cards = parse_decklist(file_path)
+        formatted, owned = bulk_add_diff(db_name, table_name, cards)
+
+        if formatted:
+            return formatted
+        if cards and owned == len(cards):
             return ["You already own every card in the file."]
-          return formatted 
+        return ["No differences added."]
 
     except Exception as e:
         return [f"An error occurred: {e}"]
 
-    finally:
-        # Close the database connection
-        conn.close()
-
 db_name = 'data.db'
 table_name = 'cards'
 column_name = 'name'
\ No newline at end of file
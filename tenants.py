@@ -0,0 +1,88 @@
+import os
+import threading
+from collections import OrderedDict
+
+from async_db import retire_writer
+from cache import drop_cache
+from compare_cache import drop_results
+from db import close_pool
+from fuzzy import drop_index
+from schema import TABLE_NAME
+
+
+# Every collection is its own SQLite file in this directory, so writes to
+# different collections never wait on the same database lock
+SHARD_DIRECTORY = os.environ.get("SHARD_DIRECTORY", "collections")
+
+# Collections whose writer thread, connections, fuzzy index and cache are kept open at once,
+# the least recently used one is closed first (and reopened when needed again)
+MAX_OPEN_SHARDS = int(os.environ.get("MAX_OPEN_SHARDS", "32"))
+
+# The collection that was shared by everyone before inventories were split,
+# it stays with its owner (see collection_for)
+LEGACY_DB = "data.db"
+
+_open_shards = OrderedDict()
+_open_shards_lock = threading.Lock()
+
+
+def shard_path(owner_id: int) -> str:
+    """
+    Return the database file of a collection.
+
+    :param owner_id: The Telegram chat id owning the collection: a user in a
+                     private chat, or a group whose members share it.
+    """
+    return os.path.join(SHARD_DIRECTORY, f"{int(owner_id)}.db")
+
+
+def collection_for(owner_id: int, legacy_owner: int = None) -> str:
+    """
+    Return the database file of a collection and mark it as recently used.
+
+    :param owner_id: The Telegram chat id owning the collection.
+    :param legacy_owner: The chat id that keeps LEGACY_DB as its collection.
+    :return: The database file name to pass to the sql.py functions.
+    """
+    if legacy_owner is not None and owner_id == legacy_owner:
+        db_name = LEGACY_DB
+    else:
+        db_name = shard_path(owner_id)
+        os.makedirs(SHARD_DIRECTORY, exist_ok=True)
+    touch(db_name)
+    return db_name
+
+
+def touch(db_name: str) -> None:
+    """
+    Mark a database as recently used, closing the least recently used ones over MAX_OPEN_SHARDS.
+    """
+    with _open_shards_lock:
+        _open_shards[db_name] = True
+        _open_shards.move_to_end(db_name)
+        evicted = []
+        while len(_open_shards) > MAX_OPEN_SHARDS:
+            evicted.append(_open_shards.popitem(last=False)[0])
+
+    for name in evicted:
+        close_shard(name)
+
+
+def close_shard(db_name: str) -> None:
+    """
+    Release everything held in memory for a database. Connections still in
+    use are closed as soon as they are released, queued writes still run.
+    """
+    drop_index(db_name, TABLE_NAME)
+    drop_cache(db_name, TABLE_NAME)
+    drop_results(db_name, TABLE_NAME)
+    retire_writer(db_name)
+    close_pool(db_name)
+
+
+def open_shards() -> list:
+    """
+    Return the open databases, least recently used first.
+    """
+    with _open_shards_lock:
+        return list(_open_shards)
@@ -0,0 +1,134 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+
+# Where the embedded web server listens. Telegram only pushes to ports 443, 80,
+# 88 and 8443, usually through a reverse proxy that terminates TLS
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+
+# Path updates are POSTed to, and the public URL Telegram is told to use.
+# Without WEBHOOK_URL the webhook is not registered, which is handy to test
+# locally by POSTing recorded updates
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+
+# Sent back by Telegram in the X-Telegram-Bot-Api-Secret-Token header, so
+# nobody else can post updates. Required: the sender of an update is only
+# known from its body, a forged one would pass check_user
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def create_app(application: Application, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET) -> web.Application:
+    """
+    Build the web app receiving updates, with health and readiness endpoints.
+
+    GET /healthz answers as long as the process runs, GET /readyz only once
+    the bot is started and accepting updates. Metrics are not served here,
+    this app is public (see metrics.start_server).
+
+    :param application: The bot application the updates are handed to.
+    :param path: The path Telegram POSTs updates to.
+    :param secret: The expected secret token.
+    :raises ValueError: If no secret is given.
+    """
+    if not secret:
+        raise ValueError("WEBHOOK_SECRET must be set in webhook mode, anyone reaching the port could post updates otherwise")
+
+    app = web.Application()
+    # Mutable, the app itself is frozen once the server starts
+    app["state"] = {"ready": False}
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=403)
+        if not app["state"]["ready"]:
+            # Telegram retries later
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+            if not isinstance(data, dict):
+                raise ValueError("not a JSON object")
+            update = Update.de_json(data, application.bot)
+        except (json.JSONDecodeError, TypeError, KeyError, ValueError, AttributeError):
+            return web.Response(status=400, text="Not a Telegram update")
+        # Answer right away, the update is handled in the background
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def handle_health(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    async def handle_ready(request: web.Request) -> web.Response:
+        if app["state"]["ready"] and application.running:
+            return web.Response(text="ready")
+        return web.Response(status=503, text="starting")
+
+    app.router.add_post(path, handle_update)
+    app.router.add_get("/healthz", handle_health)
+    app.router.add_get("/readyz", handle_ready)
+    return app
+
+
+async def serve(application: Application, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT) -> None:
+    """
+    Run the bot behind the embedded web server until SIGINT or SIGTERM.
+
+    Does what run_polling does around the updater: runs post_init,
+    post_stop and post_shutdown and starts/stops the application.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # e.g. Windows, Ctrl+C then raises KeyboardInterrupt
+
+    app = create_app(application)
+    runner = web.AppRunner(app, access_log=None)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        await application.start()
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+        app["state"]["ready"] = True
+        logging.warning(f"Listening for updates on {listen}:{port}{WEBHOOK_PATH}")
+
+        await stop.wait()
+    finally:
+        app["state"]["ready"] = False
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run(application: Application) -> None:
+    """
+    Blocking entry point, the webhook counterpart of application.run_polling().
+    """
+    asyncio.run(serve(application))